@@ -1,9 +1,10 @@
 BEGIN TRANSACTION;
-DROP TABLE IF EXISTS "stop_times";
-CREATE TABLE IF NOT EXISTS "stop_times" (
-	"trip_id"	TEXT NOT NULL,
-	"stop_id"	TEXT,
-	"stop_sequence"	INTEGER
+DROP TABLE IF EXISTS "stop_route_services";
+CREATE TABLE IF NOT EXISTS "stop_route_services" (
+	"stop_id"	TEXT NOT NULL,
+	"route_id"	TEXT NOT NULL,
+	"service_id"	TEXT NOT NULL,
+	PRIMARY KEY("stop_id","route_id","service_id")
 );
 DROP TABLE IF EXISTS "cycle_stops";
 CREATE TABLE IF NOT EXISTS "cycle_stops" (
@@ -13,6 +14,7 @@ CREATE TABLE IF NOT EXISTS "cycle_stops" (
 	"cycle_lon"	REAL NOT NULL,
 	"cycle_type"	INTEGER NOT NULL,
 	"cycle_free"	INTEGER NOT NULL,
+	"cycle_geohash"	TEXT,
 	PRIMARY KEY("cycle_id")
 );
 DROP TABLE IF EXISTS "cache_stop_routes";
@@ -51,36 +53,68 @@ CREATE TABLE IF NOT EXISTS "stops" (
 	"stop_lat"	REAL NOT NULL,
 	"stop_lon"	REAL NOT NULL,
 	"wheelchair_boarding"	INTEGER,
+	"stop_geohash"	TEXT,
 	PRIMARY KEY("stop_id")
 );
-DROP TABLE IF EXISTS "trips";
-CREATE TABLE IF NOT EXISTS "trips" (
-	"trip_id"	TEXT NOT NULL,
-	"route_id"	TEXT NOT NULL,
-	"service_id"	TEXT NOT NULL,
-	"direction_id"	INTEGER,
-	"wheelchair_accessible"	INTEGER,
-	"bikes_allowed"	INTEGER,
-	PRIMARY KEY("trip_id")
-);
-DROP INDEX IF EXISTS "stop_times_stop_id";
-CREATE INDEX IF NOT EXISTS "stop_times_stop_id" ON "stop_times" (
-	"stop_id"
+DROP TABLE IF EXISTS "stop_summary";
+CREATE TABLE IF NOT EXISTS "stop_summary" (
+	"stop_id"	TEXT NOT NULL,
+	"stop_name"	TEXT NOT NULL,
+	"stop_lat"	REAL NOT NULL,
+	"stop_lon"	REAL NOT NULL,
+	"routes"	TEXT NOT NULL,
+	"area_id"	INTEGER,
+	PRIMARY KEY("stop_id")
 );
-DROP INDEX IF EXISTS "stop_times_trip_id";
-CREATE INDEX IF NOT EXISTS "stop_times_trip_id" ON "stop_times" (
-	"trip_id"
+DROP TABLE IF EXISTS "stop_areas";
+CREATE TABLE IF NOT EXISTS "stop_areas" (
+	"area_id"	INTEGER NOT NULL,
+	"area_name"	TEXT NOT NULL,
+	"area_lat"	REAL NOT NULL,
+	"area_lon"	REAL NOT NULL,
+	"area_radius"	REAL NOT NULL,
+	PRIMARY KEY("area_id")
 );
-DROP INDEX IF EXISTS "trips_service_id";
-CREATE INDEX IF NOT EXISTS "trips_service_id" ON "trips" (
-	"service_id"
+DROP TABLE IF EXISTS "build_sources";
+CREATE TABLE IF NOT EXISTS "build_sources" (
+	"base_id"	TEXT NOT NULL,
+	"sha256"	TEXT NOT NULL,
+	PRIMARY KEY("base_id")
 );
-DROP INDEX IF EXISTS "trips_route_id";
-CREATE INDEX IF NOT EXISTS "trips_route_id" ON "trips" (
+DROP INDEX IF EXISTS "stop_route_services_route_id";
+CREATE INDEX IF NOT EXISTS "stop_route_services_route_id" ON "stop_route_services" (
 	"route_id"
 );
 DROP INDEX IF EXISTS "routes_route_long_name";
 CREATE INDEX IF NOT EXISTS "routes_route_long_name" ON "routes" (
 	"route_long_name"
 );
+DROP INDEX IF EXISTS "stop_summary_area_id";
+CREATE INDEX IF NOT EXISTS "stop_summary_area_id" ON "stop_summary" (
+	"area_id"
+);
+DROP INDEX IF EXISTS "stops_stop_geohash";
+CREATE INDEX IF NOT EXISTS "stops_stop_geohash" ON "stops" (
+	"stop_geohash"
+);
+DROP INDEX IF EXISTS "cycle_stops_cycle_geohash";
+CREATE INDEX IF NOT EXISTS "cycle_stops_cycle_geohash" ON "cycle_stops" (
+	"cycle_geohash"
+);
+DROP TABLE IF EXISTS "stops_rtree";
+CREATE VIRTUAL TABLE IF NOT EXISTS "stops_rtree" USING rtree(
+	"id",
+	"min_lat",
+	"max_lat",
+	"min_lon",
+	"max_lon"
+);
+DROP TABLE IF EXISTS "cycle_stops_rtree";
+CREATE VIRTUAL TABLE IF NOT EXISTS "cycle_stops_rtree" USING rtree(
+	"id",
+	"min_lat",
+	"max_lat",
+	"min_lon",
+	"max_lon"
+);
 COMMIT;
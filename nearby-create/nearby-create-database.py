@@ -9,22 +9,44 @@ The aim of the database is to allow fast queries to find the closest stops and
 routes to a given location. This is why additional processes are done to remove
 unnecessary data and to generate a cache between stops and routes.
 
-Note: This script has a memory usage peak of around 1.5 GB when importing data.
+Note: CSV files are streamed from the GTFS archives straight into the database,
+so the memory usage does not depend on the size of the feeds.
+
+Usage:
+    nearby-create-database.py transport.db
+    nearby-create-database.py --refresh-lovelo transport.db
+
+The second form only refreshes the Lovélo stations of an existing database,
+it can be run every few minutes while the database is being served.
+
+The database is never modified in place: it is built in a copy which then
+atomically replaces it, so that readers always see a complete database.
 """
 
-from sys import argv
-from os import remove
-from os.path import getctime, dirname, realpath
-from time import time
+from sys import argv, exit
+from typing import Iterable, Iterator
+from os import remove, replace
+from fcntl import flock, LOCK_EX, LOCK_UN
+from os.path import exists, dirname, realpath
+from time import sleep, perf_counter
+from resource import getrusage, RUSAGE_SELF, RUSAGE_CHILDREN
 from sqlite3 import connect, Row
-from collections import defaultdict
-from csv import DictReader
+from itertools import chain, islice
+from csv import DictReader, reader as csv_reader
 from zipfile import ZipFile
 from io import TextIOWrapper
-from math import radians
+from math import radians, degrees, asin, sin, cos, sqrt
 from datetime import datetime
-from json import loads, load
-from requests import get, codes as HTTP_CODES
+from functools import partial
+from contextlib import closing
+from pathlib import Path
+from multiprocessing import Process, Queue
+from queue import Empty
+from concurrent.futures import ThreadPoolExecutor
+from traceback import format_exc
+from json import loads, load, dump, dumps
+from hashlib import sha256
+from requests import get, Session, RequestException, codes as HTTP_CODES
 
 SCRIPT_DIRECTORY = dirname(realpath(__file__))
 TRANSPORT_DB_SQL = SCRIPT_DIRECTORY + "/nearby-create-database.db.sql"
@@ -39,10 +61,45 @@ PERFORMANCE_SQLITE_PRAGMAS = {
     "temp_store": "MEMORY",
 }
 
+# Suffix of the copy in which a database is built before replacing it, and of
+# the lock file serializing the builds of a database or the downloads of a
+# data file.
+BUILD_SUFFIX = ".build"
+LOCK_SUFFIX = ".lock"
+
+# Suffix of the file, stored next to the database, remembering the names of
+# the database normalized by the previous builds along with the hash of the
+# corrections they were normalized with.
+NAMES_CACHE_SUFFIX = ".names.json"
+
+# Build the database in memory and write it to disk once complete, instead of
+# going through the disk at each step. Builds need enough memory to hold the
+# whole database, including the stop_route_services of the stops kept in the
+# Métropole Rouen Normandie.
+BUILD_IN_MEMORY = True
+
+# Base URL of the transport.data.gouv.fr datasets API.
+DATAGOUV_API = "https://transport.data.gouv.fr/api/datasets"
+
+# Maximum number of sources downloaded at the same time, and number of
+# attempts for each source before giving up.
+DOWNLOAD_WORKERS = 6
+DOWNLOAD_ATTEMPTS = 3
+
+# Suffix of the file, stored next to each downloaded file, remembering the
+# validators (ETag, Last-Modified) and the content hash of the last download.
+DOWNLOAD_STATE_SUFFIX = ".state.json"
+
+# Downloads are streamed to disk by chunks of this size (in bytes) into a
+# temporary file with this suffix, renamed once complete.
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+DOWNLOAD_PART_SUFFIX = ".part"
+
 # DataGouvIds. Identifiers below have been extracted from the API
 # https://transport.data.gouv.fr/api/datasets
 DATA_FILES = {
     "astuce": {
+        "base_id": "AST-",
         "type": "gtfs",
         "description": "Métropole Rouen Normandie Réseau Astuce GTFS data",
         "datagouv_id": "5cd4321f8b4c4137d1244318",
@@ -50,6 +107,7 @@ DATA_FILES = {
         "temp_file": "/tmp/astuce.gtfs.zip",
     },
     "cycling": {
+        "base_id": "CYC-",
         "type": "csv",
         "description": "Métropole Rouen Normandie cycling data",
         "datagouv_id": "61f3ef4cc1ed500d1b135719",
@@ -57,6 +115,7 @@ DATA_FILES = {
         "temp_file": "/tmp/cycling.csv",
     },
     "lovélo": {
+        "base_id": "LOV-",
         "type": "gbfs",
         "gbfs_key": "station_information",
         "description": "Métropole Rouen Normandie Lovélo data",
@@ -65,6 +124,7 @@ DATA_FILES = {
         "temp_file": "/tmp/lovelo.json",
     },
     "atoumod": {
+        "base_id": "ATM-",
         "type": "gtfs",
         "description": "Région Normandie AtouMod GTFS data",
         "datagouv_id": "5ced52ed8b4c4177b679d377",
@@ -72,6 +132,7 @@ DATA_FILES = {
         "temp_file": "/tmp/atoumod.gtfs.zip",
     },
     "flixbus": {
+        "base_id": "FLX-",
         "type": "gtfs",
         "description": "Flixbus GTFS data",
         "datagouv_id": "5c6ad5248b4c411c3d7ae435",
@@ -79,6 +140,7 @@ DATA_FILES = {
         "temp_file": "/tmp/flixbus.gtfs.zip",
     },
     "blablacarbus": {
+        "base_id": "BBC-",
         "type": "gtfs",
         "description": "BlaBlaCar Bus GTFS data",
         "datagouv_id": "5cdef3698b4c416d21fd76b9",
@@ -88,6 +150,26 @@ DATA_FILES = {
 }
 
 
+# GTFS feeds to import, each one is parsed by its own process.
+GTFS_FEEDS = ["blablacarbus", "flixbus", "astuce", "atoumod"]
+
+# Sources to import again when another source changes. AtouMod duplicates are
+# found by comparing AtouMod routes with all Réseau Astuce routes, including
+# the ones removed afterwards as orphans, so both are always imported together.
+SOURCE_DEPENDENCIES = {"astuce": ["atoumod"], "atoumod": ["astuce"]}
+
+# Tables and ID columns holding the rows imported from a source, the IDs
+# being prefixed with the base_id of the source.
+SOURCE_TABLES = [
+    ("stops", "stop_id"),
+    ("routes", "route_id"),
+    ("calendar", "service_id"),
+    ("calendar_dates", "service_id"),
+    ("cache_stop_routes", "stop_id"),
+    ("stop_route_services", "stop_id"),
+    ("cycle_stops", "cycle_id"),
+]
+
 # Bounding box of the Métropole Rouen Normandie.
 MRN_FAR_EAST = {"lat": 49.48682, "lon": 0.77446}
 MRN_FAR_NORTH = {"lat": 49.54676, "lon": 0.85565}
@@ -99,6 +181,24 @@ MIN_LATITUDE = min(MRN_FAR_NORTH["lat"], MRN_FAR_SOUTH["lat"])
 MAX_LONGITUDE = max(MRN_FAR_EAST["lon"], MRN_FAR_WEST["lon"])
 MIN_LONGITUDE = min(MRN_FAR_EAST["lon"], MRN_FAR_WEST["lon"])
 
+# Same-name stops closer than STOP_AREA_RADIUS meters to the first stop of an
+# area are grouped in this area.
+EARTH_DIAMETER = 12742000
+STOP_AREA_RADIUS = 150
+
+# Geohash precision of the cells stored with stops and cycle stops. A cell of
+# 6 characters is around 610 m high and 790 m wide in Rouen, so the 9 cells
+# around a location cover any radius up to 300 m.
+GEOHASH_PRECISION = 6
+GEOHASH_ALPHABET = "0123456789bcdefghjkmnpqrstuvwxyz"
+
+# Number of records sent to SQLite in each executemany call.
+INSERT_BATCH_SIZE = 10000
+
+# Tables generated from the other ones at each build. Incremental builds drop
+# them, so that they follow the schema.
+GENERATED_TABLES = ["stop_summary", "stop_areas"]
+
 # Fields to prefix with the base_id when importing GTFS data.
 FIELD_IDS = ["trip_id", "stop_id", "route_id", "service_id", "cycle_id"]
 
@@ -154,6 +254,14 @@ class CannotDownload(Exception):
         (self.url, self.status_code) = (url, status_code)
 
 
+class CannotImport(Exception):
+    """Exception raised when the import of a data file fails."""
+
+    def __init__(self, message: str, filename: str):
+        super().__init__(message)
+        self.filename = filename
+
+
 def load_corrections(filename: str):
     """Load corrections from a file.
 
@@ -161,51 +269,153 @@ def load_corrections(filename: str):
         filename (str): The filename of the corrections file.
     """
     with open(filename, encoding="utf-8") as corrections_file:
-        return [
-            line.split("\t")
+        return tuple(
+            tuple(line.split("\t", 1))
             for line in corrections_file.read().splitlines()
             if "\t" in line
-        ]
+        )
 
 
 CORRECTIONS = load_corrections(CORRECTIONS_TXT)
 
+# Normalized names, indexed by raw name.
+NORMALIZED_NAMES = {}
+
+# Raw names normalized by the current build.
+USED_NAMES = set()
+
+
+def connect_read_only(db_filename: str):
+    """Open an existing database read-only, it is never created.
+
+    Args:
+        db_filename (str): The filename of the database.
+    """
+    uri = Path(db_filename).absolute().as_uri() + "?mode=ro"
+    return connect(uri, uri=True)
+
 
-class SQLiteDB:
-    """Context manager to handle a SQLite database connection."""
+class BuildDB:
+    """Context manager to build a database, possibly from an existing one.
 
-    def __init__(self, db_filename):
-        self.db_filename = db_filename
+    When BUILD_IN_MEMORY is set, the database is built in memory and written
+    once complete, otherwise it is built in its file.
+
+    The connection does not open transactions implicitly, each build step runs
+    in its own transaction (see run_step). The database is analyzed by the
+    analyze_database step.
+    """
+
+    def __init__(self, build_filename, source_filename=None):
+        self.db_filename = ":memory:" if BUILD_IN_MEMORY else build_filename
+        self.build_filename = build_filename
+        self.source_filename = source_filename
         self.connection = None
         self.cursor = None
 
     def __enter__(self):
-        self.connection = connect(self.db_filename)
+        remove_database(self.build_filename)
+        self.connection = connect(self.db_filename, isolation_level=None)
         self.connection.row_factory = Row
         self.cursor = self.connection.cursor()
 
+        if self.source_filename is not None:
+            source = connect_read_only(self.source_filename)
+            try:
+                source.backup(self.connection)
+            finally:
+                source.close()
+
+        # Pragmas are set after the copy, which brings the journal mode of the
+        # source database along.
         for key, value in PERFORMANCE_SQLITE_PRAGMAS.items():
             self.cursor.execute(f"PRAGMA {key} = {value}")
 
         return self.cursor
 
+    def __exit__(self, exc_type, *args):
+        if exc_type is None:
+            self.connection.commit()
+            self.finish()
+        else:
+            self.connection.rollback()
+
+        self.connection.close()
+
+    def finish(self):
+        """Write the database to its file if it has been built in memory."""
+        if not BUILD_IN_MEMORY:
+            return
+
+        destination = connect(self.build_filename)
+        try:
+            self.connection.backup(destination)
+        finally:
+            destination.close()
+
+
+class FileLock:
+    """Context manager to prevent concurrent writes of a file.
+
+    It serializes the builds of a database and the downloads of a data file.
+    The lock is held on a file next to the locked one, it is released by the
+    system if the process dies.
+    """
+
+    def __init__(self, filename):
+        self.lock_filename = filename + LOCK_SUFFIX
+        self.lock_file = None
+
+    def __enter__(self):
+        self.lock_file = open(self.lock_filename, "w", encoding="utf-8")
+        flock(self.lock_file, LOCK_EX)
+        return self
+
     def __exit__(self, *args):
-        self.connection.commit()
+        flock(self.lock_file, LOCK_UN)
+        self.lock_file.close()
 
-        # Let SQLite3 analyze the database to optimize future queries.
-        self.cursor.execute("PRAGMA analysis_limit = 40000")
-        self.cursor.execute("PRAGMA optimize")
 
-        self.connection.close()
+def remove_database(db_filename: str):
+    """Remove a database and its journal files, if they exist.
+
+    Args:
+        db_filename (str): The filename of the database.
+    """
+    for suffix in ["", "-journal", "-wal", "-shm"]:
+        try:
+            remove(db_filename + suffix)
+        except FileNotFoundError:
+            pass
+
 
+def install_database(build_filename: str, db_filename: str):
+    """Atomically replace a database with a newly built one.
 
-def download_json(url: str):
+    The new database is switched to the rollback journal: the write-ahead log
+    of a database is a file next to it, which SQLite would otherwise apply to
+    the new database as long as readers keep the old one open.
+
+    Args:
+        build_filename (str): The filename of the newly built database.
+        db_filename (str): The filename of the database to replace.
+    """
+    connection = connect(build_filename)
+    connection.execute("PRAGMA journal_mode = DELETE")
+    connection.close()
+
+    replace(build_filename, db_filename)
+
+
+def download_json(url: str, session=None):
     """Download a JSON file from a URL.
 
     Args:
         url (str): The URL of the JSON file.
+        session (requests.Session, optional): The HTTP session to use. Defaults
+            to None, meaning no session is used.
     """
-    res = get(url, timeout=30)
+    res = (session.get if session else get)(url, timeout=30)
 
     if res.status_code != HTTP_CODES.ok:
         raise CannotDownload("Failed to download JSON", url, res.status_code)
@@ -213,50 +423,205 @@ def download_json(url: str):
     return loads(res.content.decode("utf-8"))
 
 
-def download_dataset_info(datagouvid: str):
+def download_dataset_info(datagouvid: str, session=None):
     """Download dataset info from DataGouv.
 
     Args:
         datagouvid (str): The DataGouv ID of the dataset.
+        session (requests.Session, optional): The HTTP session to use. Defaults
+            to None, meaning no session is used.
+    """
+    dataset_url = f"{DATAGOUV_API}/{datagouvid}"
+    return download_json(dataset_url, session)
+
+
+def load_download_state(filename: str) -> dict:
+    """Load the state of the last download of a file.
+
+    Args:
+        filename (str): The filename of the downloaded file.
+
+    Returns:
+        dict: The state (url, etag, last_modified, sha256) of the last
+        download, empty if the file or its state is missing.
+    """
+    if not exists(filename):
+        return {}
+
+    try:
+        with open(filename + DOWNLOAD_STATE_SUFFIX, encoding="utf-8") as state:
+            return load(state)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def file_checksum(filename: str) -> str:
+    """Get the SHA-256 of a downloaded file.
+
+    The checksum computed while downloading is used when available, otherwise
+    the file is read again.
+
+    Args:
+        filename (str): The filename of the downloaded file.
+    """
+    # The file and its state are read while no download is replacing them.
+    with FileLock(filename):
+        state = load_download_state(filename)
+        if state.get("sha256"):
+            return state["sha256"]
+
+        checksum = sha256()
+        with open(filename, "rb") as file:
+            for chunk in iter(partial(file.read, DOWNLOAD_CHUNK_SIZE), b""):
+                checksum.update(chunk)
+
+        return checksum.hexdigest()
+
+
+def save_download_state(filename: str, state: dict):
+    """Save the state of the last download of a file.
+
+    Args:
+        filename (str): The filename of the downloaded file.
+        state (dict): The state to save.
     """
-    dataset_url = f"https://transport.data.gouv.fr/api/datasets/{datagouvid}"
-    return download_json(dataset_url)
+    with open(filename + DOWNLOAD_STATE_SUFFIX, "w", encoding="utf-8") as handle:
+        dump(state, handle)
 
 
-def download_as(url: str, filename: str):
+def download_as(url: str, filename: str, session=None) -> bool:
     """Download a file from a URL.
 
+    The request is conditional when the file has already been downloaded from
+    the same URL: the server answers 304 Not Modified if it has not changed.
+
+    Concurrent downloads of the same file wait for each other, the file is
+    replaced and its state saved while holding its lock.
+
     Args:
         url (str): The URL of the file to download.
         filename (str): The filename to save the file.
+        session (requests.Session, optional): The HTTP session to use. Defaults
+            to None, meaning no session is used.
+
+    Returns:
+        bool: True if the content of the file has changed, False otherwise.
     """
-    res = get(url, timeout=30)
+    # The refresh of the Lovélo stations may run during the nightly download,
+    # both would otherwise write the same temporary file.
+    with FileLock(filename):
+        state = load_download_state(filename)
+
+        headers = {}
+        if state.get("url") == url:
+            if state.get("etag"):
+                headers["If-None-Match"] = state["etag"]
+            if state.get("last_modified"):
+                headers["If-Modified-Since"] = state["last_modified"]
+
+        request = session.get if session else get
+        with request(url, headers=headers, timeout=30, stream=True) as res:
+            if res.status_code == HTTP_CODES.not_modified:
+                return False
+
+            if res.status_code != HTTP_CODES.ok:
+                raise CannotDownload("Failed to download file", url, res.status_code)
+
+            # Stream the file to a temporary file so that an interrupted download
+            # never replaces a previously complete file.
+            checksum = sha256()
+            size = 0
+            part_filename = filename + DOWNLOAD_PART_SUFFIX
+            try:
+                with open(part_filename, "wb") as file:
+                    for chunk in res.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                        checksum.update(chunk)
+                        size += len(chunk)
+                        file.write(chunk)
+
+                # Content-Length is the size before decoding when the content is
+                # compressed, it can only be verified for identity encoding.
+                expected_size = res.headers.get("Content-Length")
+                if (
+                    expected_size is not None
+                    and "Content-Encoding" not in res.headers
+                    and int(expected_size) != size
+                ):
+                    raise CannotDownload("Truncated download", url, res.status_code)
+            except BaseException:
+                # A failed download must not leave its partial file behind.
+                if exists(part_filename):
+                    remove(part_filename)
+                raise
+
+            replace(part_filename, filename)
+
+        save_download_state(
+            filename,
+            {
+                "url": url,
+                "etag": res.headers.get("ETag"),
+                "last_modified": res.headers.get("Last-Modified"),
+                "sha256": checksum.hexdigest(),
+            },
+        )
 
-    if res.status_code != HTTP_CODES.ok:
-        raise CannotDownload("Failed to download file", url, res.status_code)
+        # Servers without validators send the file again, compare the contents.
+        return checksum.hexdigest() != state.get("sha256")
+
+
+def zip_contains(zipfile: str, filename: str) -> bool:
+    """Check if a ZIP archive contains a file.
 
-    with open(filename, "wb") as file:
-        for chunk in res.iter_content():
-            file.write(chunk)
+    Args:
+        zipfile (str): The ZIP archive file.
+        filename (str): The file to look for in the ZIP archive.
+    """
+    with ZipFile(zipfile) as handle:
+        return filename in handle.namelist()
 
 
-def load_csv_from_zip(zipfile: str, csvfile: str) -> list:
-    """Load a CSV file from a ZIP archive.
+def load_csv_from_zip(zipfile: str, csvfile: str, columns=None) -> Iterator[dict]:
+    """Stream the rows of a CSV file from a ZIP archive.
     The CSV file is expected to be encoded in UTF-8 with BOM.
 
+    Rows are decompressed and parsed one at a time while they are consumed.
+
     Args:
         zipfile (str): The ZIP archive file.
         csvfile (str): The CSV file to load from the ZIP archive.
+        columns (list, optional): The only columns to keep in the rows. Columns
+            missing from the CSV file are ignored. Defaults to None, meaning
+            all columns are kept.
     """
     with ZipFile(zipfile) as handle:
         with TextIOWrapper(handle.open(csvfile), encoding="utf-8-sig") as csv:
-            content = [row for row in DictReader(csv)]
+            if columns is None:
+                yield from DictReader(csv)
+                return
+
+            rows = csv_reader(csv)
+            header = next(rows, [])
+            projection = [
+                (column, index)
+                for (index, column) in enumerate(header)
+                if column in columns
+            ]
+
+            for row in rows:
+                # Blank lines are skipped and short rows are padded like
+                # DictReader does.
+                if not row:
+                    continue
 
-    return content
+                if len(row) < len(header):
+                    row += [None] * (len(header) - len(row))
 
+                yield {column: row[index] for (column, index) in projection}
 
-def load_csv(csvfile: str, delimiter=",") -> list:
-    """Load a CSV file.
+
+def load_csv(csvfile: str, delimiter=",") -> Iterator[dict]:
+    """Stream the rows of a CSV file.
 
     Args:
         csvfile (str): The CSV file to load.
@@ -264,73 +629,262 @@ def load_csv(csvfile: str, delimiter=",") -> list:
             to ','.
     """
     with open(csvfile, encoding="utf-8-sig") as csv:
-        content = [row for row in DictReader(csv, delimiter=delimiter)]
+        yield from DictReader(csv, delimiter=delimiter)
+
+
+def schema_statements(drops=True) -> Iterator[str]:
+    """Stream the statements of the database schema from TRANSPORT_DB_SQL.
+
+    The transaction of the schema file is left out, statements are run in the
+    transaction of the build step.
+
+    Args:
+        drops (bool, optional): Whether to include the DROP statements.
+            Defaults to True.
+    """
+    with open(TRANSPORT_DB_SQL, encoding="utf-8") as schema_file:
+        statements = schema_file.read().split(";")
 
-    return content
+    for statement in statements:
+        statement = statement.strip()
+        if statement in ("", "BEGIN TRANSACTION", "COMMIT"):
+            continue
 
+        if drops or not statement.startswith("DROP "):
+            yield statement
 
-def create_database(db_filename: str):
-    """Create a SQLite database with the given filename.
 
-    The database schema is loaded from TRANSPORT_DB_SQL file.
+def create_database(cursor):
+    """Create the tables and indexes of the database.
 
     Args:
-        db_filename (str): The filename of the SQLite database."""
-    with SQLiteDB(db_filename) as cursor:
-        with open(TRANSPORT_DB_SQL, encoding="utf-8") as schema_file:
-            cursor.executescript(schema_file.read())
+        cursor (sqlite3.Cursor): The cursor to use."""
+    for statement in schema_statements():
+        cursor.execute(statement)
+
+
+def update_database(cursor):
+    """Create the missing tables and indexes of an existing database.
+
+    The DROP statements of the schema are left out, so that existing tables and
+    their rows are kept, except for the GENERATED_TABLES.
+
+    Args:
+        cursor (sqlite3.Cursor): The cursor to use."""
+    for table_name in GENERATED_TABLES:
+        cursor.execute(f'DROP TABLE IF EXISTS "{table_name}"')
+
+    for statement in schema_statements(drops=False):
+        cursor.execute(statement)
 
 
-def sql_insert(table_name: str, record: dict, ignore=False) -> str:
-    """Generate an SQL INSERT statement.
+def remove_sources(cursor, sources: list):
+    """Remove the rows imported from some sources.
+
+    Args:
+        cursor (sqlite3.Cursor): The cursor to use.
+        sources (list): The keys of the sources in DATA_FILES.
+    """
+    # The remaining relations come from sources that will not be imported
+    # again, they are not needed anymore.
+    cursor.execute("DELETE FROM stop_route_services")
+
+    for source in sources:
+        base_id = DATA_FILES[source]["base_id"]
+        for table_name, column in SOURCE_TABLES:
+            sql = f"DELETE FROM {table_name} WHERE {column} LIKE ?"
+            cursor.execute(sql, (base_id + "%",))
+
+        cursor.execute("DELETE FROM build_sources WHERE base_id = ?", (base_id,))
+
+
+def sql_insert(table_name: str, columns: list, ignore=False) -> str:
+    """Generate an SQL INSERT statement with positional parameters.
 
     Args:
         table_name (str): The name of the table.
-        record (dict): The record to insert.
+        columns (list): The columns to insert, in the order of the parameters.
         ignore (bool, optional): Whether to ignore duplicates when inserting.
             Defaults to False.
     """
-    columns = ", ".join(record.keys())
-    variables = ", ".join([":" + column for column in record.keys()])
+    names = ", ".join(columns)
+    variables = ", ".join(["?"] * len(columns))
     ignore = " OR IGNORE" if ignore else ""
-    return f"INSERT{ignore} INTO {table_name}({columns}) VALUES({variables});"
+    return f"INSERT{ignore} INTO {table_name}({names}) VALUES({variables});"
 
 
 def normalize_name(name: str) -> str:
     """Normalize a name by applying a set of corrections.
 
+    Each correction is applied to the result of the previous ones, so the
+    order of the corrections file matters. The same names come back for every
+    feed and every build, hence the results are memoized in NORMALIZED_NAMES.
+
     Args:
         name (str): The name to normalize.
     """
+    USED_NAMES.add(name)
+    if name in NORMALIZED_NAMES:
+        return NORMALIZED_NAMES[name]
+
     # Set the name to title case.
-    name = name.title()
+    normalized = name.title()
+
+    for (bad, good) in CORRECTIONS:
+        normalized = normalized.replace(bad, good)
+
+    NORMALIZED_NAMES[name] = normalized
+    return normalized
+
+
+def corrections_checksum() -> str:
+    """Get the SHA-256 of the corrections file."""
+    with open(CORRECTIONS_TXT, "rb") as corrections_file:
+        return sha256(corrections_file.read()).hexdigest()
+
+
+def load_names_cache(db_filename: str):
+    """Load the names normalized by the previous builds of a database.
+
+    It starts a build: the names used by the build are recorded from then on.
+    The cache is ignored if it is missing, unreadable, not shaped like a saved
+    cache or if the corrections file has changed since it was saved.
+
+    Args:
+        db_filename (str): The filename of the database.
+    """
+    USED_NAMES.clear()
+
+    try:
+        with open(db_filename + NAMES_CACHE_SUFFIX, encoding="utf-8") as handle:
+            cache = load(handle)
+
+        if cache["corrections"] == corrections_checksum():
+            NORMALIZED_NAMES.update(dict(cache["names"]))
+    except (FileNotFoundError, AttributeError, KeyError, TypeError, ValueError):
+        return
+
+
+def save_names_cache(db_filename: str):
+    """Save the normalized names of a database next to it for the next builds.
+
+    Only the names used by the build and the names of the rows it kept from
+    the previous database are saved, so names leaving the feeds are dropped.
+
+    Args:
+        db_filename (str): The filename of the database.
+    """
+    with closing(connect_read_only(db_filename)) as connection:
+        kept_names = {
+            name
+            for (name,) in connection.execute(
+                """
+                SELECT stop_name FROM stops
+                UNION SELECT route_long_name FROM routes
+                UNION SELECT cycle_name FROM cycle_stops
+            """
+            )
+        }
+
+    names = {
+        name: normalized
+        for (name, normalized) in NORMALIZED_NAMES.items()
+        if name in USED_NAMES or normalized in kept_names
+    }
+
+    cache = {"corrections": corrections_checksum(), "names": names}
+    with open(db_filename + NAMES_CACHE_SUFFIX, "w", encoding="utf-8") as handle:
+        dump(cache, handle, ensure_ascii=False)
+
 
-    for [bad, good] in CORRECTIONS:
-        name = name.replace(bad, good)
+def batched(records: Iterable, size: int) -> Iterator[list]:
+    """Split records into lists of at most size records.
 
-    return name
+    Args:
+        records (Iterable): The records to split.
+        size (int): The maximum number of records in a list.
+    """
+    records = iter(records)
+    while batch := list(islice(records, size)):
+        yield batch
 
 
-def import_table(cursor, table_name: str, base_id: str, records: list, ignore=False):
-    """Import a list of records into a table.
+def import_table(
+    cursor, table_name: str, base_id: str, records: Iterable[dict], ignore=False
+):
+    """Import records into a table.
+
+    Records are consumed one batch of INSERT_BATCH_SIZE records at a time, they
+    may come from a generator. All records are expected to have the same keys
+    as the first one, the INSERT statement and the column mapping are computed
+    once from it.
 
     Args:
         cursor (sqlite3.Cursor): The cursor to use to import.
         table_name (str): The name of the table.
         base_id (str): The base ID to prefix to the IDs in the records. The IDs
             are defined in FIELD_IDS.
-        records (list): The records to import, indexed by the column names.
+        records (Iterable[dict]): The records to import, indexed by the column
+            names.
         ignore (bool, optional): Whether to ignore duplicates when inserting.
             Defaults to False.
     """
-    for record in records:
-        values = {
-            key: (base_id + record[key] if key in FIELD_IDS else record[key])
-            for key in record
-            if (key not in FIELD_DROPS and f"{table_name}.{key}" not in FIELD_DROPS)
-        }
+    records = iter(records)
+    first = next(records, None)
+    if first is None:
+        return
+
+    columns = [
+        key
+        for key in first
+        if (key not in FIELD_DROPS and f"{table_name}.{key}" not in FIELD_DROPS)
+    ]
+    mapping = [(key, key in FIELD_IDS) for key in columns]
+
+    rows = (
+        tuple(
+            base_id + record[key] if prefixed else record[key]
+            for (key, prefixed) in mapping
+        )
+        for record in chain([first], records)
+    )
+
+    sql = sql_insert(table_name, columns, ignore)
+    for batch in batched(rows, INSERT_BATCH_SIZE):
+        cursor.executemany(sql, batch)
+
+
+def geohash(latitude: float, longitude: float, precision=GEOHASH_PRECISION) -> str:
+    """Encode a location as a geohash.
+
+    Args:
+        latitude (float): The latitude in degrees.
+        longitude (float): The longitude in degrees.
+        precision (int, optional): The number of characters of the geohash.
+            Defaults to GEOHASH_PRECISION.
+    """
+    (lat_min, lat_max) = (-90.0, 90.0)
+    (lon_min, lon_max) = (-180.0, 180.0)
 
-        cursor.execute(sql_insert(table_name, values, ignore), defaultdict(str, values))
+    cell = []
+    for char_index in range(precision):
+        value = 0
+        for bit_index in range(5):
+            # Bits alternate between longitude and latitude, longitude first.
+            if (char_index * 5 + bit_index) % 2 == 0:
+                middle = (lon_min + lon_max) / 2
+                bit = longitude >= middle
+                (lon_min, lon_max) = (middle, lon_max) if bit else (lon_min, middle)
+            else:
+                middle = (lat_min + lat_max) / 2
+                bit = latitude >= middle
+                (lat_min, lat_max) = (middle, lat_max) if bit else (lat_min, middle)
+
+            value = value * 2 + bit
+
+        cell.append(GEOHASH_ALPHABET[value])
+
+    return "".join(cell)
 
 
 def derive_cycle_type(mobilier: str) -> int:
@@ -376,17 +930,17 @@ def derive_cycle_longitude(coordonneesxy: str) -> float:
     return float(coordonneesxy[1:-1].split(",")[0])
 
 
-def import_cycle_data(db_filename: str):
+def import_cycle_data(cursor):
     """Import cycle data into the database.
 
     Args:
-        db_filename (str): The filename of the database.
+        cursor (sqlite3.Cursor): The cursor to use.
     """
 
     # Métropole Rouen Normandie cycle data uses ';' as delimiter.
     cycle_data = load_csv(DATA_FILES["cycling"]["temp_file"], ";")
 
-    cycle_stops = [
+    cycle_stops = (
         {
             "cycle_id": row["id_local"],
             "cycle_name": None,
@@ -396,24 +950,20 @@ def import_cycle_data(db_filename: str):
             "cycle_free": derive_cycle_free(row["acces"]),
         }
         for row in cycle_data
-    ]
+    )
 
-    with SQLiteDB(db_filename) as cursor:
-        import_table(cursor, "cycle_stops", "CYC-", cycle_stops)
+    import_table(cursor, "cycle_stops", DATA_FILES["cycling"]["base_id"], cycle_stops)
 
 
-def import_lovelo(db_filename: str):
-    """Import Lovélo data into the database.
+def load_lovelo_stops() -> Iterator[dict]:
+    """Stream Lovélo stations from the downloaded GBFS station information.
 
-    Args:
-        db_filename (str): The filename of the database.
+    Station names are normalized and coordinates are converted to radians.
     """
-
-    # Métropole Rouen Normandie cycle data uses ';' as delimiter.
     with open(DATA_FILES["lovélo"]["temp_file"], "rb") as gbfs:
         lovelo_data = load(gbfs)["data"]["stations"]
 
-    lovelo_stops = [
+    return (
         {
             "cycle_id": row["station_id"],
             "cycle_name": normalize_name(row["name"]),
@@ -423,143 +973,305 @@ def import_lovelo(db_filename: str):
             "cycle_free": derive_cycle_free("PAYANT"),
         }
         for row in lovelo_data
-    ]
+    )
+
+
+def import_lovelo(cursor):
+    """Import Lovélo data into the database.
+
+    Args:
+        cursor (sqlite3.Cursor): The cursor to use.
+    """
+    import_table(
+        cursor, "cycle_stops", DATA_FILES["lovélo"]["base_id"], load_lovelo_stops()
+    )
+
 
-    with SQLiteDB(db_filename) as cursor:
-        import_table(cursor, "cycle_stops", "LOV-", lovelo_stops)
+def table_columns(cursor, table_name: str) -> list:
+    """Get the columns of a table from the database schema.
+
+    Args:
+        cursor (sqlite3.Cursor): The cursor to use.
+        table_name (str): The name of the table.
+    """
+    cursor.execute(f"PRAGMA table_info({table_name})")
+    return [row["name"] for row in cursor.fetchall()]
 
 
-def import_gtfs_data(zipfile: str, base_id: str, db_filename: str):
-    """Import GTFS data into the database from a ZIP file.
+def load_gtfs_routes(zipfile: str, columns: list, route_ids: set) -> Iterator[dict]:
+    """Stream GTFS routes while normalizing route_long_name.
+
+    Only the routes serving at least one kept stop are streamed.
 
     Args:
         zipfile (str): The ZIP file containing the GTFS data.
-        base_id (str): The base ID for prefixing the IDs in the records. The IDs
-            are defined in FIELD_IDS.
-        db_filename (str): The filename of the database.
+        columns (list): The columns to keep.
+        route_ids (set): The IDs of the routes to keep.
     """
+    for route in load_csv_from_zip(zipfile, "routes.txt", columns):
+        if route["route_id"] not in route_ids:
+            continue
+
+        route["route_long_name"] = normalize_name(route["route_long_name"])
+        yield route
 
-    datas = {}
 
-    # Import routes while normalizing route_long_name.
-    datas["routes"] = []
-    for row in load_csv_from_zip(zipfile, "routes.txt"):
-        route = row
-        route["route_long_name"] = normalize_name(row["route_long_name"])
-        datas["routes"].append(route)
+def load_gtfs_stops(zipfile: str, columns: list, stop_ids: set) -> Iterator[dict]:
+    """Stream GTFS stops located in the Métropole Rouen Normandie.
 
-    datas["trips"] = load_csv_from_zip(zipfile, "trips.txt")
-    datas["stop_times"] = load_csv_from_zip(zipfile, "stop_times.txt")
+    Stop names are normalized and coordinates are converted to radians.
 
-    datas["stops"] = []
-    for row in load_csv_from_zip(zipfile, "stops.txt"):
+    Args:
+        zipfile (str): The ZIP file containing the GTFS data.
+        columns (list): The columns to keep.
+        stop_ids (set): Receives the IDs of the streamed stops.
+    """
+    for stop in load_csv_from_zip(zipfile, "stops.txt", columns):
         # Ignore stops outside the Métropole Rouen Normandie.
-        latitude = float(row["stop_lat"])
+        latitude = float(stop["stop_lat"])
         if latitude < MIN_LATITUDE or latitude > MAX_LATITUDE:
             continue
 
-        longitude = float(row["stop_lon"])
+        longitude = float(stop["stop_lon"])
         if longitude < MIN_LONGITUDE or longitude > MAX_LONGITUDE:
             continue
 
-        stop = row
-        stop["stop_name"] = normalize_name(row["stop_name"])
+        stop["stop_name"] = normalize_name(stop["stop_name"])
         stop["stop_lat"] = radians(latitude)
         stop["stop_lon"] = radians(longitude)
-        datas["stops"].append(stop)
+        stop_ids.add(stop["stop_id"])
+        yield stop
+
+
+def load_gtfs_stop_route_services(
+    zipfile: str, stop_ids: set, route_ids: set
+) -> Iterator[dict]:
+    """Stream the stops, routes and services related by GTFS trips.
+
+    The trips are kept in memory while stop_times are streamed, only the
+    columns needed to relate stops to routes are parsed. The stop_times of
+    stops which have not been kept are skipped, as are the relations already
+    streamed, so most of the national feeds never reach the database.
+
+    Args:
+        zipfile (str): The ZIP file containing the GTFS data.
+        stop_ids (set): The IDs of the kept stops.
+        route_ids (set): Receives the IDs of the routes serving a kept stop.
+    """
+    trips = {
+        trip["trip_id"]: (trip["route_id"], trip["service_id"])
+        for trip in load_csv_from_zip(
+            zipfile, "trips.txt", ["trip_id", "route_id", "service_id"]
+        )
+    }
+
+    relations = set()
+    stop_times = load_csv_from_zip(zipfile, "stop_times.txt", ["trip_id", "stop_id"])
+    for stop_time in stop_times:
+        if stop_time["stop_id"] not in stop_ids or stop_time["trip_id"] not in trips:
+            continue
+
+        (route_id, service_id) = trips[stop_time["trip_id"]]
+        relation = (stop_time["stop_id"], route_id, service_id)
+        if relation in relations:
+            continue
+
+        relations.add(relation)
+        route_ids.add(route_id)
+        yield {
+            "stop_id": stop_time["stop_id"],
+            "route_id": route_id,
+            "service_id": service_id,
+        }
+
+
+def load_gtfs_tables(zipfile: str, columns: dict) -> Iterator[tuple]:
+    """Stream the records of a GTFS feed, table by table.
+
+    Only the columns of the database schema are parsed. The trips and
+    stop_times files are reduced on the fly to the distinct stop, route and
+    service triplets needed by the following steps, they are never stored.
+
+    Stops are streamed first, so that only the stop_times of the kept stops
+    and then only the routes serving them are streamed. Each table must be
+    consumed before the next one is requested.
+
+    Args:
+        zipfile (str): The ZIP file containing the GTFS data.
+        columns (dict): The columns of each table, indexed by table name.
+
+    Yields:
+        (table_name, records, ignore) tuples, ready for import_table.
+    """
+    (stop_ids, route_ids) = (set(), set())
+    yield ("stops", load_gtfs_stops(zipfile, columns["stops"], stop_ids), False)
+    yield (
+        "stop_route_services",
+        load_gtfs_stop_route_services(zipfile, stop_ids, route_ids),
+        True,
+    )
+    yield (
+        "routes",
+        load_gtfs_routes(zipfile, columns["routes"], route_ids),
+        False,
+    )
+
+    if zip_contains(zipfile, "calendar.txt"):
+        (table_name, csvfile) = ("calendar", "calendar.txt")
+    else:
+        (table_name, csvfile) = ("calendar_dates", "calendar_dates.txt")
+
+    yield (
+        table_name,
+        load_csv_from_zip(zipfile, csvfile, columns[table_name]),
+        False,
+    )
+
+
+def parse_gtfs_data(feed: str, columns: dict, batches: Queue):
+    """Parse a GTFS feed and send its records to a queue.
+
+    This function runs in its own process. Records are sent by batches of
+    INSERT_BATCH_SIZE as (feed, table_name, records, ignore) tuples. The names
+    used by the process are then sent with a "names" table name, so that they
+    can be saved in the names cache. The end of the feed is signaled with a
+    None table name and failures with an "error" table name followed by the
+    traceback.
+
+    Args:
+        feed (str): The key of the GTFS feed in DATA_FILES.
+        columns (dict): The columns of each table, indexed by table name.
+        batches (Queue): The queue receiving the batches.
+    """
+    zipfile = DATA_FILES[feed]["temp_file"]
 
     try:
-        datas["calendar"] = load_csv_from_zip(zipfile, "calendar.txt")
-        datas["calendar_dates"] = None
-    except KeyError:
-        datas["calendar"] = None
-        datas["calendar_dates"] = load_csv_from_zip(zipfile, "calendar_dates.txt")
-
-    with SQLiteDB(db_filename) as cursor:
-        import_table(cursor, "routes", base_id, datas["routes"])
-        import_table(cursor, "stops", base_id, datas["stops"])
-        import_table(cursor, "stop_times", base_id, datas["stop_times"])
-        import_table(cursor, "trips", base_id, datas["trips"])
-
-        if datas["calendar_dates"]:
-            import_table(cursor, "calendar_dates", base_id, datas["calendar_dates"])
-        else:
-            import_table(cursor, "calendar", base_id, datas["calendar"])
+        for table_name, records, ignore in load_gtfs_tables(zipfile, columns):
+            for batch in batched(records, INSERT_BATCH_SIZE):
+                batches.put((feed, table_name, batch, ignore))
 
+        names = {name: NORMALIZED_NAMES[name] for name in USED_NAMES}
+        batches.put((feed, "names", names, None))
+        batches.put((feed, None, None, None))
+    except Exception:
+        batches.put((feed, "error", format_exc(), None))
 
-def generate_gtfs_cache(db_filename: str):
-    """Generate a cache between stops and routes.
 
-    This is necessary to speed up queries to find the closest stops and routes
-    because the stops and routes are not directly related in the GTFS data, one
-    needs to go through the stop_times and trips tables to find the
-    relationship.
+def import_gtfs_data(cursor, feeds=None):
+    """Import GTFS feeds into the database.
+
+    Each feed is decompressed, parsed, filtered and normalized in its own
+    process while this process is the only one writing to the database. The
+    queue between them is bounded so that fast parsers wait for the writer
+    instead of piling records up in memory.
 
     Args:
-        db_filename (str): The filename of the database.
+        cursor (sqlite3.Cursor): The cursor to use.
+        feeds (list, optional): The keys of the GTFS feeds to import. Defaults
+            to None, meaning all GTFS_FEEDS.
     """
-    with SQLiteDB(db_filename) as cursor:
-        sql = """
-            SELECT DISTINCT
-                stop_times.stop_id AS "stop_id",
-                trips.route_id     AS "route_id",
-                trips.service_id   AS "service_id"
-            FROM stop_times
-            INNER JOIN trips ON stop_times.trip_id = trips.trip_id
-        """
-        cursor.execute(sql)
+    feeds = GTFS_FEEDS if feeds is None else feeds
+    columns = {
+        table_name: table_columns(cursor, table_name)
+        for table_name in ["routes", "stops", "calendar", "calendar_dates"]
+    }
 
-        route_stops = [
-            {
-                "stop_id": row["stop_id"],
-                "route_id": row["route_id"],
-                "school": 1 if row["service_id"].startswith("AST-IST") else 0,
-            }
-            for row in cursor.fetchall()
-        ]
+    batches = Queue(maxsize=2 * len(feeds))
+    parsers = {
+        feed: Process(target=parse_gtfs_data, args=(feed, columns, batches))
+        for feed in feeds
+    }
 
-        import_table(cursor, "cache_stop_routes", "", route_stops, True)
+    for parser in parsers.values():
+        parser.start()
 
+    try:
+        while parsers:
+            try:
+                (feed, table_name, records, ignore) = batches.get(timeout=1)
+            except Empty:
+                # A parser killed before sending its last batch would
+                # otherwise be waited for forever.
+                for feed, parser in parsers.items():
+                    if parser.exitcode:
+                        raise CannotImport(
+                            f"Parser exited with code {parser.exitcode}",
+                            DATA_FILES[feed]["temp_file"],
+                        )
+                continue
+
+            if table_name == "error":
+                raise CannotImport(records, DATA_FILES[feed]["temp_file"])
+
+            if table_name == "names":
+                NORMALIZED_NAMES.update(records)
+                USED_NAMES.update(records)
+                continue
+
+            if table_name is None:
+                parsers.pop(feed).join()
+                step(f"Imported {DATA_FILES[feed]['description']}")
+                continue
+
+            base_id = DATA_FILES[feed]["base_id"]
+            import_table(cursor, table_name, base_id, records, ignore)
+    finally:
+        for parser in parsers.values():
+            parser.kill()
+            parser.join()
+
+
+def generate_gtfs_cache(cursor):
+    """Generate a cache between stops and routes.
 
-def remove_trips(db_filename: str, trip_ids: list):
-    """Remove trips and associated stops and routes from the database.
+    This is necessary to speed up queries to find the closest stops and routes
+    because the stops and routes are not directly related in the GTFS data, one
+    needs to go through the stop_times and trips files to find the
+    relationship, which the import has reduced to the stop_route_services
+    table.
 
     Args:
-        db_filename (str): The filename of the database.
-        trip_ids (list): The list of trip IDs to remove.
+        cursor (sqlite3.Cursor): The cursor to use.
+    """
+    # Rows are copied by SQLite itself, without going through Python.
+    sql = """
+        INSERT OR IGNORE INTO cache_stop_routes(stop_id, route_id, school)
+        SELECT DISTINCT
+            stop_id,
+            route_id,
+            SUBSTR(service_id, 1, 7) = 'AST-IST' AS "school"
+        FROM stop_route_services
     """
-    with SQLiteDB(db_filename) as cursor:
-        # Find all stops associated with the trip.
-        sql_params = ",".join(["?"] * len(trip_ids))
-        sql = f"SELECT stop_id FROM stop_times WHERE trip_id IN ({sql_params})"
-        cursor.execute(sql, trip_ids)
-        stop_ids = {row["stop_id"] for row in cursor.fetchall()}
+    cursor.execute(sql)
+
 
-        # Find all routes associated with the trip.
-        sql = f"SELECT route_id FROM trips WHERE trip_id IN ({sql_params})"
-        cursor.execute(sql, trip_ids)
-        route_ids = {row["route_id"] for row in cursor.fetchall()}
+def remove_services(cursor, condition: str):
+    """Remove services and associated stops and routes from the database.
 
-        # Delete trips.
-        sql = f"DELETE FROM trips WHERE trip_id IN ({sql_params})"
-        cursor.execute(sql, trip_ids)
+    Args:
+        cursor (sqlite3.Cursor): The cursor to use.
+        condition (str): The SQL condition on service_id selecting the
+            services to remove.
+    """
+    # Stops and routes are found through the relations of the services, so
+    # these relations are deleted last.
+    stop_ids = f"SELECT stop_id FROM stop_route_services WHERE {condition}"
+    route_ids = f"SELECT route_id FROM stop_route_services WHERE {condition}"
 
-        # Delete stops associated with the trip.
-        sql_params = ",".join(["?"] * len(stop_ids))
-        sql = f"DELETE FROM stops WHERE stop_id IN ({sql_params})"
-        cursor.execute(sql, list(stop_ids))
+    # Delete stops associated with the services.
+    cursor.execute(f"DELETE FROM stops WHERE stop_id IN ({stop_ids})")
 
-        # Delete cache_stop_routes associated with the trip.
-        sql = f"DELETE FROM cache_stop_routes WHERE stop_id IN ({sql_params})"
-        cursor.execute(sql, list(stop_ids))
+    # Delete cache_stop_routes associated with the services.
+    cursor.execute(f"DELETE FROM cache_stop_routes WHERE stop_id IN ({stop_ids})")
 
-        # Delete routes associated with the trip.
-        sql_params = ",".join(["?"] * len(route_ids))
-        sql = f"DELETE FROM routes WHERE route_id IN ({sql_params})"
-        cursor.execute(sql, list(route_ids))
+    # Delete routes associated with the services.
+    cursor.execute(f"DELETE FROM routes WHERE route_id IN ({route_ids})")
 
+    # Delete services.
+    cursor.execute(f"DELETE FROM stop_route_services WHERE {condition}")
 
-def remove_elevators(db_filename: str):
+
+def remove_elevators(cursor):
     """Remove elevators from the database.
 
     The Réseau Astuce GTFS data contains trips targeting elevators. This
@@ -567,29 +1279,18 @@ def remove_elevators(db_filename: str):
     useful for stops and routes queries.
 
     Args:
-        db_filename (str): The filename of the database.
+        cursor (sqlite3.Cursor): The cursor to use.
     """
-    with SQLiteDB(db_filename) as cursor:
-        # Find all trips targeting elevators.
-        sql = """
-            SELECT trip_id
-            FROM trips
-            WHERE service_id LIKE 'AST-ASCESC%'
-            OR service_id LIKE 'AST-___ASC'
-        """
-        trips = [row["trip_id"] for row in cursor.execute(sql)]
-
-        # Delete elevators.
-        cursor.execute("DELETE FROM stops WHERE stop_id LIKE 'AST-___ASC'")
-
-    remove_trips(db_filename, trips)
+    # Delete elevators.
+    cursor.execute("DELETE FROM stops WHERE stop_id LIKE 'AST-___ASC'")
 
-    with SQLiteDB(db_filename) as cursor:
-        # Delete elevators.
-        cursor.execute("DELETE FROM stops WHERE stop_id LIKE 'AST-___ASC'")
+    # Delete services targeting elevators.
+    remove_services(
+        cursor, "(service_id LIKE 'AST-ASCESC%' OR service_id LIKE 'AST-___ASC')"
+    )
 
 
-def remove_atoumod_duplicates(db_filename: str):
+def remove_atoumod_duplicates(cursor):
     """Remove AtouMod duplicates from the database.
 
     AtouMod GTFS data contains duplicates of Réseau Astuce routes. This function
@@ -598,161 +1299,321 @@ def remove_atoumod_duplicates(db_filename: str):
     AtouMod routes have the same name as Réseau Astuce routes but without '<>'.
 
     Args:
-        db_filename (str): The filename of the database.
+        cursor (sqlite3.Cursor): The cursor to use.
     """
-    with SQLiteDB(db_filename) as cursor:
-        # Find all routes from Réseau Astuce.
-        # Remove '<>' from route_long_name because AtouMod routes have the same
-        # name but without '<>' (This explains why AtouMod routes have double
-        # spaces in their names.)
-        sql = "SELECT route_long_name FROM routes WHERE route_id LIKE 'AST-%'"
-        route_long_names = []
-        for row in cursor.execute(sql):
-            route_long_names.append(row["route_long_name"].replace("<>", ""))
-            route_long_names.append(row["route_long_name"].replace("<>", "/"))
-
-        # Find routes from AtouMod with the same long name.
-        sql_params = ",".join(["?"] * len(route_long_names))
-        sql = f"""
-            SELECT route_id
+    # Find routes from AtouMod with the same long name as a route from Réseau
+    # Astuce. Remove '<>' from route_long_name because AtouMod routes have the
+    # same name but without '<>' (This explains why AtouMod routes have double
+    # spaces in their names.)
+    route_ids = """
+        SELECT route_id
+        FROM routes
+        WHERE route_id LIKE 'ATM-%'
+        AND route_long_name IN (
+            SELECT REPLACE(route_long_name, '<>', '')
             FROM routes
-            WHERE route_long_name IN ({sql_params})
-            AND route_id LIKE 'ATM-%'
+            WHERE route_id LIKE 'AST-%'
+            UNION
+            SELECT REPLACE(route_long_name, '<>', '/')
+            FROM routes
+            WHERE route_id LIKE 'AST-%'
+        )
+    """
+
+    # Delete services associated with the routes.
+    cursor.execute(f"DELETE FROM stop_route_services WHERE route_id IN ({route_ids})")
+
+    # Delete cache_stop_routes associated with the routes.
+    cursor.execute(f"DELETE FROM cache_stop_routes WHERE route_id IN ({route_ids})")
+
+    # Delete routes, last since the duplicates are found from them.
+    cursor.execute(f"DELETE FROM routes WHERE route_id IN ({route_ids})")
+
+
+def remove_orphaned_stop_route_services(cursor):
+    """Remove orphaned stop_route_services from the database.
+
+    An orphaned stop_route_service is a stop_route_service that references a
+    stop that does not exist in the stops table.
+
+    Args:
+        cursor (sqlite3.Cursor): The cursor to use.
+    """
+    cursor.execute(
         """
-        route_ids = [row["route_id"] for row in cursor.execute(sql, route_long_names)]
+        DELETE FROM stop_route_services
+        WHERE NOT EXISTS (
+            SELECT 1 FROM stops WHERE stops.stop_id = stop_route_services.stop_id
+        )
+    """
+    )
 
-        sql_params = ",".join(["?"] * len(route_ids))
 
-        # Delete trips associated with the routes.
-        sql = f"DELETE FROM trips WHERE route_id IN ({sql_params})"
-        cursor.execute(sql, list(route_ids))
+def remove_orphaned_routes(cursor, feeds=None):
+    """Remove orphaned routes from the database.
 
-        # Delete routes.
-        sql = f"DELETE FROM routes WHERE route_id IN ({sql_params})"
-        cursor.execute(sql, list(route_ids))
+    An orphaned route is a route that does not serve any stop.
+
+    Args:
+        cursor (sqlite3.Cursor): The cursor to use.
+        feeds (list, optional): The keys of the GTFS feeds whose routes are
+            checked, stop_route_services must hold all their relations.
+            Defaults to None, meaning all GTFS_FEEDS.
+    """
+    feeds = GTFS_FEEDS if feeds is None else feeds
+
+    sql = """
+        DELETE FROM routes
+        WHERE route_id LIKE ?
+        AND NOT EXISTS (
+            SELECT 1
+            FROM stop_route_services
+            WHERE stop_route_services.route_id = routes.route_id
+        )
+    """
+    cursor.executemany(
+        sql, [(DATA_FILES[feed]["base_id"] + "%",) for feed in feeds]
+    )
 
-        # Delete cache_stop_routes associated with the routes.
-        sql = f"DELETE FROM cache_stop_routes WHERE route_id in ({sql_params})"
-        cursor.execute(sql, list(route_ids))
 
+def convert_calendar_dates(cursor):
+    """Convert calendar_dates to calendar.
 
-def remove_orphaned_stop_times(db_filename: str):
-    """Remove orphaned stop_times from the database.
+    While the calendar table contains the start and end dates of a service, the
+    calendar_dates table contains only specific dates.
 
-    An orphaned stop_time is a stop_time that references a stop that does not
-    exist in the stops table.
+    This function converts the calendar_dates table to the calendar table by
+    finding the start and end dates of a service. This makes the database
+    schema more consistent, and lighter.
 
     Args:
-        db_filename (str): The filename of the database.
+        cursor (sqlite3.Cursor): The cursor to use.
     """
-    with SQLiteDB(db_filename) as cursor:
-        # Find all orphaned stop_times.
-        sql = """
-            SELECT stop_times.stop_id AS 'stop_id'
-            FROM stop_times
-            LEFT JOIN stops ON stop_times.stop_id = stops.stop_id
-            WHERE stops.stop_id IS NULL
+    # Convert calendar_dates to calendar.
+    cursor.execute(
         """
-        stop_ids = {row["stop_id"] for row in cursor.execute(sql)}
+        INSERT INTO calendar(service_id, start_date, end_date)
+        SELECT
+            service_id AS 'service_id',
+            MIN(date) AS 'start_date',
+            MAX(date) AS 'end_date' 
+        FROM calendar_dates
+        GROUP BY service_id
+    """
+    )
 
-        # Delete orphaned stop_times.
-        sql_params = ",".join(["?"] * len(stop_ids))
-        sql = f"DELETE FROM stop_times WHERE stop_id IN ({sql_params})"
-        cursor.execute(sql, list(stop_ids))
+    # Drop the original calendar_dates table.
+    cursor.execute("DROP TABLE calendar_dates")
 
 
-def remove_orphaned_trips(db_filename: str):
-    """Remove orphaned trips from the database.
+def shrink_database(cursor):
+    """Shrink the database to reduce its size.
 
-    An orphaned trip is a trip that does not have any stop_times.
+    This function reclaims unused space in the database file since a lot of
+    records has been erased.
 
     Args:
-        db_filename (str): The filename of the database.
+        cursor (sqlite3.Cursor): The cursor to use.
     """
-    with SQLiteDB(db_filename) as cursor:
-        # Find all orphaned trips.
-        sql = """
-            SELECT trips.trip_id AS 'trip_id'
-            FROM trips
-            LEFT JOIN stop_times ON trips.trip_id = stop_times.trip_id
-            WHERE stop_times.trip_id IS NULL
-        """
-        trip_ids = {row["trip_id"] for row in cursor.execute(sql)}
+    cursor.execute("DROP TABLE stop_route_services")
 
-        # Delete orphaned trips.
-        sql_params = ",".join(["?"] * len(trip_ids))
-        sql = f"DELETE FROM trips WHERE trip_id IN ({sql_params})"
-        cursor.execute(sql, list(trip_ids))
+    # VACUUM cannot run inside the transaction of the step.
+    cursor.execute("COMMIT")
+    cursor.execute("VACUUM")
+    cursor.execute("BEGIN")
 
 
-def remove_orphaned_routes(db_filename: str):
-    """Remove orphaned routes from the database.
+def analyze_database(cursor):
+    """Gather the statistics used by the query planner of the readers.
+
+    Args:
+        cursor (sqlite3.Cursor): The cursor to use.
+    """
+    cursor.execute("PRAGMA analysis_limit = 40000")
+    cursor.execute("ANALYZE")
 
-    An orphaned route is a route that does not have any trips.
+
+def generate_geohashes(cursor):
+    """Store the geohash cell of every stop and cycle stop.
+
+    The geohash columns are indexed, which allows finding the stops around a
+    location with plain SQL by querying the neighbouring cells.
 
     Args:
-        db_filename (str): The filename of the database.
+        cursor (sqlite3.Cursor): The cursor to use.
     """
-    with SQLiteDB(db_filename) as cursor:
-        # Find all orphaned routes.
-        sql = """
-            SELECT routes.route_id AS 'route_id'
-            FROM routes
-            LEFT JOIN trips ON routes.route_id = trips.route_id
-            WHERE trips.route_id IS NULL
+    cursor.connection.create_function(
+        "GEOHASH",
+        2,
+        lambda lat, lon: geohash(degrees(lat), degrees(lon)),
+        deterministic=True,
+    )
+
+    # Only rows imported since the last build have no geohash yet.
+    cursor.execute(
+        """
+        UPDATE stops
+        SET stop_geohash = GEOHASH(stop_lat, stop_lon)
+        WHERE stop_geohash IS NULL
+    """
+    )
+    cursor.execute(
         """
-        route_ids = {row["route_id"] for row in cursor.execute(sql)}
+        UPDATE cycle_stops
+        SET cycle_geohash = GEOHASH(cycle_lat, cycle_lon)
+        WHERE cycle_geohash IS NULL
+    """
+    )
 
-        # Delete orphaned routes.
-        sql_params = ",".join(["?"] * len(route_ids))
-        sql = f"DELETE FROM routes WHERE route_id IN ({sql_params})"
-        cursor.execute(sql, list(route_ids))
 
+def generate_spatial_index(cursor):
+    """Generate the R*Tree spatial indexes of stops and cycle stops.
 
-def convert_calendar_dates(db_filename: str):
-    """Convert calendar_dates to calendar.
+    Each stop is stored as a degenerate bounding box (a point) keyed on the
+    rowid of the stop. This allows queries to narrow candidates with a bounding
+    box lookup before computing the exact distance.
 
-    While the calendar table contains the start and end dates of a service, the
-    calendar_dates table contains only specific dates.
+    The indexes must be generated after the database has been shrunk because
+    VACUUM may change the rowids of tables without an INTEGER PRIMARY KEY.
 
-    This function converts the calendar_dates table to the calendar table by
-    finding the start and end dates of a service. This makes the database
-    schema more consistent, and lighter.
+    Args:
+        cursor (sqlite3.Cursor): The cursor to use.
+    """
+    cursor.execute("DELETE FROM stops_rtree")
+    cursor.execute(
+        """
+        INSERT INTO stops_rtree(id, min_lat, max_lat, min_lon, max_lon)
+        SELECT rowid, stop_lat, stop_lat, stop_lon, stop_lon
+        FROM stops
+    """
+    )
+
+    cursor.execute("DELETE FROM cycle_stops_rtree")
+    cursor.execute(
+        """
+        INSERT INTO cycle_stops_rtree(id, min_lat, max_lat, min_lon, max_lon)
+        SELECT rowid, cycle_lat, cycle_lat, cycle_lon, cycle_lon
+        FROM cycle_stops
+    """
+    )
+
+
+def generate_stop_summaries(cursor):
+    """Generate one summary row per stop, holding the routes serving it.
+
+    The routes are stored as a JSON list of [route_short_name,
+    route_long_name, school] lists ordered by school, so that a stop and its
+    routes are read without any join. Summaries share the rowid of their stop,
+    hence its entry in the spatial index, they must be generated after the
+    database has been shrunk.
 
     Args:
-        db_filename (str): The filename of the database.
+        cursor (sqlite3.Cursor): The cursor to use.
     """
-    with SQLiteDB(db_filename) as cursor:
-        # Convert calendar_dates to calendar.
-        cursor.execute(
-            """
-            INSERT INTO calendar(service_id, start_date, end_date)
-            SELECT
-                service_id AS 'service_id',
-                MIN(date) AS 'start_date',
-                MAX(date) AS 'end_date' 
-            FROM calendar_dates
-            GROUP BY service_id
+    cursor.execute("DELETE FROM stop_summary")
+    cursor.execute(
         """
+        INSERT INTO stop_summary(
+            rowid, stop_id, stop_name, stop_lat, stop_lon, routes
         )
+        SELECT
+            stops.rowid,
+            stops.stop_id,
+            stops.stop_name,
+            stops.stop_lat,
+            stops.stop_lon,
+            json_group_array(json(stop_routes.route))
+        FROM stops
+        INNER JOIN (
+            SELECT
+                cache_stop_routes.stop_id AS stop_id,
+                json_array(
+                    routes.route_short_name,
+                    routes.route_long_name,
+                    cache_stop_routes.school
+                ) AS route
+            FROM cache_stop_routes
+            INNER JOIN routes
+                    ON cache_stop_routes.route_id = routes.route_id
+            ORDER BY cache_stop_routes.school, routes.route_id
+        ) AS stop_routes
+                ON stops.stop_id = stop_routes.stop_id
+        GROUP BY stops.rowid
+    """
+    )
 
-        # Drop the original calendar_dates table.
-        cursor.execute("DROP TABLE calendar_dates")
 
+def gps_distance(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    """Get the distance in meters between two locations.
 
-def shrink_database(db_filename: str):
-    """Shrink the database to reduce its size.
+    Args:
+        lat1 (float): The latitude of the first location in radians.
+        lon1 (float): The longitude of the first location in radians.
+        lat2 (float): The latitude of the second location in radians.
+        lon2 (float): The longitude of the second location in radians.
+    """
+    return EARTH_DIAMETER * asin(
+        sqrt(
+            sin((lat2 - lat1) / 2) ** 2
+            + cos(lat1) * cos(lat2) * sin((lon2 - lon1) / 2) ** 2
+        )
+    )
 
-    This function reclaims unused space in the database file since a lot of
-    records has been erased.
+
+def generate_stop_areas(cursor):
+    """Group the stops having the same name and close to each other in areas.
+
+    Each stop joins the first area of its name whose first stop is closer than
+    STOP_AREA_RADIUS, or starts a new area. An area stores the centroid of its
+    stops and the distance from the centroid to its farthest stop, queries can
+    then skip whole areas without looking at their stops.
 
     Args:
-        db_filename (str): The filename of the database.
+        cursor (sqlite3.Cursor): The cursor to use.
     """
-    with SQLiteDB(db_filename) as cursor:
-        cursor.execute("DROP TABLE stop_times")
-        cursor.execute("DROP TABLE trips")
-        cursor.execute("VACUUM")
+    cursor.execute("DELETE FROM stop_areas")
+    cursor.execute(
+        """
+        SELECT rowid, stop_name, stop_lat, stop_lon
+        FROM stop_summary
+        ORDER BY rowid
+    """
+    )
+
+    areas = []
+    areas_by_name = {}
+    for stop in cursor.fetchall():
+        location = (stop["stop_lat"], stop["stop_lon"])
+        for area in areas_by_name.setdefault(stop["stop_name"], []):
+            if gps_distance(*area["stops"][0][1], *location) < STOP_AREA_RADIUS:
+                area["stops"].append((stop["rowid"], location))
+                break
+        else:
+            area = {"name": stop["stop_name"], "stops": [(stop["rowid"], location)]}
+            areas_by_name[stop["stop_name"]].append(area)
+            areas.append(area)
+
+    rows = []
+    members = []
+    for area_id, area in enumerate(areas, 1):
+        latitude = sum(lat for (_, (lat, _)) in area["stops"]) / len(area["stops"])
+        longitude = sum(lon for (_, (_, lon)) in area["stops"]) / len(area["stops"])
+        radius = max(
+            gps_distance(latitude, longitude, *location)
+            for (_, location) in area["stops"]
+        )
+
+        rows.append((area_id, area["name"], latitude, longitude, radius))
+        members.extend((area_id, rowid) for (rowid, _) in area["stops"])
+
+    cursor.executemany(
+        """
+        INSERT INTO stop_areas(area_id, area_name, area_lat, area_lon, area_radius)
+        VALUES(?, ?, ?, ?, ?)
+    """,
+        rows,
+    )
+    cursor.executemany("UPDATE stop_summary SET area_id = ? WHERE rowid = ?", members)
 
 
 def step(message: str):
@@ -764,6 +1625,35 @@ def step(message: str):
     print(f"{datetime.now().isoformat()}\t{message}")
 
 
+def run_step(cursor, step_name: str, step_function):
+    """Run a build step in its own transaction and print its metrics.
+
+    The metrics are printed as a JSON object: the duration of the step, the
+    number of rows it inserted, updated or deleted, and the peak resident set
+    size so far of this process and of the GTFS parsers.
+
+    Args:
+        cursor (sqlite3.Cursor): The cursor of the database being built.
+        step_name (str): The name of the step.
+        step_function (callable): The step, taking the cursor as argument.
+    """
+    step(step_name)
+    (start, changes) = (perf_counter(), cursor.connection.total_changes)
+
+    cursor.execute("BEGIN")
+    step_function(cursor)
+    cursor.execute("COMMIT")
+
+    metrics = {
+        "step": step_name,
+        "seconds": round(perf_counter() - start, 3),
+        "rows": cursor.connection.total_changes - changes,
+        "peak_rss_kib": getrusage(RUSAGE_SELF).ru_maxrss,
+        "parsers_peak_rss_kib": getrusage(RUSAGE_CHILDREN).ru_maxrss,
+    }
+    step(dumps(metrics, ensure_ascii=False))
+
+
 def get_resource(info: dict, res_id):
     """Get a ressource from a dataset info.
 
@@ -774,14 +1664,16 @@ def get_resource(info: dict, res_id):
     return next((res for res in info["resources"] if res["id"] == res_id), None)
 
 
-def get_gbfs_url(url: dict, feed_name: str):
+def get_gbfs_url(url: dict, feed_name: str, session=None):
     """Get the URL of a GBFS feed.
 
     Args:
         url (str): The URL of the GBFS feed.
         feed_name (str): The name of the feed to find.
+        session (requests.Session, optional): The HTTP session to use. Defaults
+            to None, meaning no session is used.
     """
-    gbfs = download_json(url)
+    gbfs = download_json(url, session)
     return next(
         (
             feed["url"]
@@ -792,56 +1684,220 @@ def get_gbfs_url(url: dict, feed_name: str):
     )
 
 
-def download_all_data():
-    """Download all data needed to generate the transport database."""
-    one_day = 24 * 60 * 60
+def download_data(data_info: dict, session=None) -> bool:
+    """Download one data file needed to generate the transport database.
 
-    for data_info in DATA_FILES.values():
-        # Determine if data has already been download less than one day ago.
-        try:
-            file_age = getctime(data_info["temp_file"])
-            is_up_to_date = (time() - file_age) < one_day
-        except FileNotFoundError:
-            is_up_to_date = False
+    The whole chain of requests (metadata, GBFS feed list and data file) is
+    tried DOWNLOAD_ATTEMPTS times before giving up.
 
-        if is_up_to_date:
-            step(f"{data_info['description']} is up to date")
-            continue
+    Args:
+        data_info (dict): The data file description, from DATA_FILES.
+        session (requests.Session, optional): The HTTP session to use. Defaults
+            to None, meaning no session is used.
 
-        step(f"Downloading {data_info['description']} metadata")
-        info = download_dataset_info(data_info["datagouv_id"])
+    Returns:
+        bool: True if the data file has changed since the last download.
+    """
+    for attempt in range(1, DOWNLOAD_ATTEMPTS + 1):
+        try:
+            step(f"Downloading {data_info['description']} metadata")
+            info = download_dataset_info(data_info["datagouv_id"], session)
 
-        resource = get_resource(info, data_info["resource_id"])
+            resource = get_resource(info, data_info["resource_id"])
 
-        if data_info["type"] == "gbfs":
-            step("Get URL of Lovélo station information")
-            url = get_gbfs_url(resource["url"], data_info["gbfs_key"])
+            if data_info["type"] == "gbfs":
+                step("Get URL of Lovélo station information")
+                url = get_gbfs_url(resource["url"], data_info["gbfs_key"], session)
+            else:
+                url = resource["url"]
 
             step(f"Downloading {data_info['description']}")
-            download_as(url, data_info["temp_file"])
+            changed = download_as(url, data_info["temp_file"], session)
+
+            if not changed:
+                step(f"{data_info['description']} is up to date")
+
+            return changed
+        except (CannotDownload, RequestException) as error:
+            if attempt == DOWNLOAD_ATTEMPTS:
+                raise
+
+            step(f"Retrying {data_info['description']} after error: {error}")
+            sleep(2**attempt)
+
+    return False
+
+
+def download_all_data(workers=DOWNLOAD_WORKERS):
+    """Download all data needed to generate the transport database.
+
+    Sources are downloaded concurrently by at most workers threads sharing one
+    HTTP session. The sources to import again are found by changed_sources,
+    from the checksums of the downloaded files.
+
+    Args:
+        workers (int, optional): The maximum number of concurrent downloads.
+            Defaults to DOWNLOAD_WORKERS.
+    """
+    with Session() as session:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            downloads = [
+                executor.submit(download_data, data_info, session)
+                for data_info in DATA_FILES.values()
+            ]
+
+            # Raise the first error, if any.
+            for download in downloads:
+                download.result()
+
+
+def source_checksums() -> dict:
+    """Get the checksums of the data files of all sources.
+
+    The checksums are computed once before importing, so that the ones
+    recorded are those of the imported files even if a file is downloaded
+    again during the build.
+
+    Returns:
+        dict: The SHA-256 of each data file, indexed by key in DATA_FILES.
+    """
+    return {
+        source: file_checksum(data_info["temp_file"])
+        for (source, data_info) in DATA_FILES.items()
+    }
+
+
+def changed_sources(db_filename: str, checksums: dict) -> list:
+    """Find the sources whose data file differs from the one last imported.
+
+    Args:
+        db_filename (str): The filename of the database.
+        checksums (dict): The SHA-256 of the data files to compare, indexed by
+            key in DATA_FILES.
+
+    Returns:
+        list: The keys of the sources in DATA_FILES to import again, including
+        the sources depending on them.
+    """
+    if not exists(db_filename):
+        return [source for source in DATA_FILES if source in checksums]
+
+    # The database may be served, it is opened read-only without any pragma.
+    with closing(connect_read_only(db_filename)) as connection:
+        connection.row_factory = Row
+        cursor = connection.cursor()
+
+        if table_columns(cursor, "build_sources"):
+            cursor.execute("SELECT base_id, sha256 FROM build_sources")
+            imported = {row["base_id"]: row["sha256"] for row in cursor.fetchall()}
         else:
-            step(f"Downloading {data_info['description']}")
-            download_as(resource["url"], data_info["temp_file"])
+            # Databases generated before build_sources existed are rebuilt.
+            imported = {}
 
+    changed = {
+        source
+        for (source, checksum) in checksums.items()
+        if imported.get(DATA_FILES[source]["base_id"]) != checksum
+    }
 
-def import_astuce_gtfs_data(db_filename: str):
-    """Import Réseau Astuce GTFS data into the database."""
-    import_gtfs_data(DATA_FILES["astuce"]["temp_file"], "AST-", db_filename)
+    for source, dependents in SOURCE_DEPENDENCIES.items():
+        if source in changed:
+            changed.update(dependents)
 
+    return [source for source in DATA_FILES if source in changed]
 
-def import_atoumod_gtfs_data(db_filename: str):
-    """Import Réseau Astuce GTFS data into the database."""
-    import_gtfs_data(DATA_FILES["atoumod"]["temp_file"], "ATM-", db_filename)
 
+def record_sources(cursor, checksums: dict):
+    """Record the checksums of the data files imported from some sources.
 
-def import_flixbus_gtfs_data(db_filename: str):
-    """Import FlixBus GTFS data into the database."""
-    import_gtfs_data(DATA_FILES["flixbus"]["temp_file"], "FLX-", db_filename)
+    Args:
+        cursor (sqlite3.Cursor): The cursor to use.
+        checksums (dict): The SHA-256 of the imported data files, indexed by
+            key in DATA_FILES.
+    """
+    cursor.executemany(
+        "INSERT OR REPLACE INTO build_sources(base_id, sha256) VALUES(?, ?)",
+        [
+            (DATA_FILES[source]["base_id"], checksum)
+            for (source, checksum) in checksums.items()
+        ],
+    )
 
 
-def import_blablacarbus_gtfs_data(db_filename: str):
-    """Import Blablacar Bus GTFS data into the database."""
-    import_gtfs_data(DATA_FILES["blablacarbus"]["temp_file"], "BBC-", db_filename)
+def build_steps(sources: list, checksums: dict) -> list:
+    """List the steps building the transport database from some sources.
+
+    Args:
+        sources (list): The keys of the sources in DATA_FILES to import.
+        checksums (dict): The SHA-256 of the data files, indexed by key in
+            DATA_FILES, recorded once the sources are imported.
+
+    Returns:
+        list: (step_name, step_function) tuples, each function taking the
+        cursor of the database being built.
+    """
+    feeds = [feed for feed in GTFS_FEEDS if feed in sources]
+
+    if len(sources) == len(DATA_FILES):
+        process_steps = [("Creating database", create_database, True)]
+    else:
+        process_steps = [
+            ("Updating database schema", update_database, True),
+            (
+                "Removing outdated data",
+                partial(remove_sources, sources=sources),
+                True,
+            ),
+        ]
+
+    # Steps are skipped when none of the sources need them.
+    process_steps += [
+        (
+            "Importing GTFS data",
+            partial(import_gtfs_data, feeds=feeds),
+            bool(feeds),
+        ),
+        ("Generating cache between stops and routes", generate_gtfs_cache, bool(feeds)),
+        (
+            "Removing AtouMod duplicates",
+            remove_atoumod_duplicates,
+            "atoumod" in sources,
+        ),
+        ("Converting calendar_dates to calendar", convert_calendar_dates, True),
+        ("Removing elevators", remove_elevators, "astuce" in sources),
+        (
+            "Removing orphaned stop_route_services",
+            remove_orphaned_stop_route_services,
+            bool(feeds),
+        ),
+        (
+            "Removing orphaned routes",
+            partial(remove_orphaned_routes, feeds=feeds),
+            bool(feeds),
+        ),
+        ("Importing cycle data", import_cycle_data, "cycling" in sources),
+        ("Importing Lovélo data", import_lovelo, "lovélo" in sources),
+        ("Generating geohashes", generate_geohashes, True),
+        ("Shrinking database", shrink_database, True),
+        ("Generating spatial index", generate_spatial_index, True),
+        ("Generating stop summaries", generate_stop_summaries, True),
+        ("Generating stop areas", generate_stop_areas, True),
+        (
+            "Recording sources",
+            partial(
+                record_sources,
+                checksums={source: checksums[source] for source in sources},
+            ),
+            True,
+        ),
+        ("Analyzing database", analyze_database, True),
+    ]
+
+    return [
+        (step_name, step_function)
+        for (step_name, step_function, needed) in process_steps
+        if needed
+    ]
 
 
 def generate_transport_database(db_filename: str):
@@ -850,43 +1906,161 @@ def generate_transport_database(db_filename: str):
     This function creates the transport database from Réseau Astuce and AtouMod
     GTFS data.
 
+    Only the sources whose data file has changed since the last build are
+    imported again, the others are kept as is. The database is generated from
+    scratch when every source has changed.
+
+    All steps share one connection to the database being built, in memory
+    when BUILD_IN_MEMORY is set. It atomically replaces the database at the
+    end, readers never see a missing or half-built database.
+
     Args:
         db_filename (str): The filename of the database.
     """
-    # Remove the database if it already exists.
-    try:
-        remove(db_filename)
-    except FileNotFoundError:
-        pass
-
-    process_steps = [
-        ("Creating database", create_database),
-        ("Importing BlaBlaCar Bus GTFS data", import_blablacarbus_gtfs_data),
-        ("Importing FlixBus GTFS data", import_flixbus_gtfs_data),
-        ("Importing Réseau Astuce GTFS data", import_astuce_gtfs_data),
-        ("Importing AtouMod GTFS data", import_atoumod_gtfs_data),
-        ("Generating cache between stops and routes", generate_gtfs_cache),
-        ("Removing AtouMod duplicates", remove_atoumod_duplicates),
-        ("Converting calendar_dates to calendar", convert_calendar_dates),
-        ("Removing elevators", remove_elevators),
-        ("Removing orphaned stop_times", remove_orphaned_stop_times),
-        ("Removing orphaned trips", remove_orphaned_trips),
-        ("Removing orphaned routes", remove_orphaned_routes),
-        ("Importing cycle data", import_cycle_data),
-        ("Importing Lovélo data", import_lovelo),
-        ("Shrinking database", shrink_database),
+    with FileLock(db_filename):
+        checksums = source_checksums()
+        sources = changed_sources(db_filename, checksums)
+
+        if not sources:
+            step("Transport database is up to date")
+            return
+
+        load_names_cache(db_filename)
+
+        if len(sources) == len(DATA_FILES):
+            source_filename = None
+        else:
+            step(f"Updating {', '.join(sources)}")
+            source_filename = db_filename
+
+        build_filename = db_filename + BUILD_SUFFIX
+        with BuildDB(build_filename, source_filename) as cursor:
+            for step_name, step_function in build_steps(sources, checksums):
+                run_step(cursor, step_name, step_function)
+
+        step("Installing database")
+        install_database(build_filename, db_filename)
+        save_names_cache(db_filename)
+
+
+def upsert_lovelo(cursor):
+    """Replace the Lovélo stations of a database with the downloaded ones.
+
+    Stations are updated in place, so they keep their rowid and thus their
+    entry in the spatial index, stations which disappeared are deleted.
+    Geohashes and the spatial index are updated along.
+
+    Args:
+        cursor (sqlite3.Cursor): The cursor to use.
+    """
+    base_id = DATA_FILES["lovélo"]["base_id"]
+
+    rows = [
+        (
+            base_id + stop["cycle_id"],
+            stop["cycle_name"],
+            stop["cycle_lat"],
+            stop["cycle_lon"],
+            stop["cycle_type"],
+            stop["cycle_free"],
+            geohash(degrees(stop["cycle_lat"]), degrees(stop["cycle_lon"])),
+        )
+        for stop in load_lovelo_stops()
     ]
 
-    for step_name, step_function in process_steps:
-        step(step_name)
-        step_function(db_filename)
+    # Delete stations which are not in the feed anymore, along with their
+    # entries in the spatial index.
+    cursor.execute(
+        "SELECT rowid, cycle_id FROM cycle_stops WHERE cycle_id LIKE ?",
+        (base_id + "%",),
+    )
+    cycle_ids = {row[0] for row in rows}
+    removed = [
+        (row["rowid"],) for row in cursor.fetchall() if row["cycle_id"] not in cycle_ids
+    ]
+    cursor.executemany("DELETE FROM cycle_stops_rtree WHERE id = ?", removed)
+    cursor.executemany("DELETE FROM cycle_stops WHERE rowid = ?", removed)
 
+    cursor.executemany(
+        """
+        INSERT INTO cycle_stops(
+            cycle_id, cycle_name, cycle_lat, cycle_lon,
+            cycle_type, cycle_free, cycle_geohash
+        )
+        VALUES(?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(cycle_id) DO UPDATE SET
+            cycle_name = excluded.cycle_name,
+            cycle_lat = excluded.cycle_lat,
+            cycle_lon = excluded.cycle_lon,
+            cycle_type = excluded.cycle_type,
+            cycle_free = excluded.cycle_free,
+            cycle_geohash = excluded.cycle_geohash
+    """,
+        rows,
+    )
 
-if __name__ == "__main__":
-    step("[Download all data]")
-    download_all_data()
+    cursor.execute(
+        """
+        INSERT OR REPLACE INTO cycle_stops_rtree(
+            id, min_lat, max_lat, min_lon, max_lon
+        )
+        SELECT rowid, cycle_lat, cycle_lat, cycle_lon, cycle_lon
+        FROM cycle_stops
+        WHERE cycle_id LIKE ?
+    """,
+        (base_id + "%",),
+    )
+
+
+def refresh_lovelo(db_filename: str):
+    """Refresh the Lovélo stations of an existing transport database.
+
+    The GBFS station information is downloaded again. If it differs from the
+    imported one, the Lovélo stations are replaced in a copy of the database,
+    which then atomically replaces the database. Transit tables are not
+    touched.
 
-    step("[Generate transport database]")
-    generate_transport_database(argv[1])
+    Args:
+        db_filename (str): The filename of the database.
+    """
+    # The other tables would be missing from a database created here.
+    if not exists(db_filename):
+        exit(f"{db_filename} does not exist, generate it before refreshing it")
+
+    with Session() as session:
+        download_data(DATA_FILES["lovélo"], session)
+
+    with FileLock(db_filename):
+        # Only the Lovélo data file is needed, the GTFS archives may be missing.
+        checksums = {"lovélo": file_checksum(DATA_FILES["lovélo"]["temp_file"])}
+        if "lovélo" not in changed_sources(db_filename, checksums):
+            step(f"{DATA_FILES['lovélo']['description']} is already imported")
+            return
+
+        load_names_cache(db_filename)
+        build_filename = db_filename + BUILD_SUFFIX
+        with BuildDB(build_filename, db_filename) as cursor:
+            run_step(cursor, "Refreshing Lovélo stations", upsert_lovelo)
+            run_step(
+                cursor,
+                "Recording sources",
+                partial(record_sources, checksums=checksums),
+            )
+
+        step("Installing database")
+        install_database(build_filename, db_filename)
+        save_names_cache(db_filename)
+
+
+if __name__ == "__main__":
+    if argv[1] == "--refresh-lovelo":
+        step("[Refresh Lovélo data]")
+        refresh_lovelo(argv[2])
+    else:
+        step("[Download all data]")
+        download_all_data()
+
+        step("[Generate transport database]")
+        generate_transport_database(argv[1])
 
     step("[Done]")
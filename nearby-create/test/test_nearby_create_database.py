@@ -0,0 +1,369 @@
+"""Regression tests of nearby-create-database.py on small synthetic sources.
+
+Each test builds transport databases in a temporary directory from GTFS
+archives, cycling CSV and Lovélo GBFS files written by the test, and checks
+the tables left once the cleanup steps have run.
+"""
+
+from contextlib import closing, redirect_stdout
+from importlib.util import module_from_spec, spec_from_file_location
+from io import StringIO
+from json import dump, load
+from os import stat
+from pathlib import Path
+from sqlite3 import connect
+from tempfile import TemporaryDirectory
+from unittest import TestCase, main
+from zipfile import ZipFile
+
+SCRIPT = Path(__file__).resolve().parent.parent / "nearby-create-database.py"
+
+# Réseau Astuce: S9 is outside the Métropole Rouen Normandie, so R4, which
+# only serves S9, is never imported and R5 has no trip at all. R3 only serves
+# the XYZASC elevator through an elevator service, both are removed.
+ASTUCE = {
+    "stops.txt": [
+        ("stop_id", "stop_name", "stop_lat", "stop_lon", "wheelchair_boarding"),
+        ("S1", "gare", "49.440000", "1.090000", "1"),
+        (),  # A blank line, skipped when parsing.
+        ("S2", "mairie", "49.450000", "1.100000", "0"),
+        ("S3", "st sever", "49.460000", "1.080000", "1"),
+        ("XYZASC", "ascenseur", "49.440100", "1.091000", "1"),
+        ("S9", "paris", "48.850000", "2.350000", "0"),
+    ],
+    "routes.txt": [
+        ("route_id", "agency_id", "route_short_name", "route_long_name", "route_type"),
+        ("R1", "TCAR", "1", "gare <> mairie", "3"),
+        ("R2", "TCAR", "2", "st sever <> paris", "3"),
+        ("R3", "TCAR", "A", "ascenseur", "3"),
+        ("R4", "TCAR", "4", "paris", "3"),
+        ("R5", "TCAR", "5", "fantome", "3"),
+    ],
+    "trips.txt": [
+        ("route_id", "service_id", "trip_id"),
+        ("R1", "WEEK", "T1"),
+        ("R1", "IST1", "T2"),
+        ("R2", "WEEK", "T3"),
+        ("R3", "ASCESC1", "T4"),
+        ("R4", "WEEK", "T5"),
+    ],
+    "stop_times.txt": [
+        ("trip_id", "arrival_time", "stop_id", "stop_sequence"),
+        ("T1", "08:00:00", "S1", "1"),
+        ("T1", "08:05:00", "S2", "2"),
+        ("T2", "07:30:00", "S1", "1"),
+        ("T3", "09:00:00", "S3", "1"),
+        ("T3", "11:00:00", "S9", "2"),
+        ("T4", "10:00:00", "XYZASC", "1"),
+        ("T5", "12:00:00", "S9", "1"),
+    ],
+    "calendar.txt": [
+        ("service_id", "monday", "start_date", "end_date"),
+        ("WEEK", "1", "20260101", "20261231"),
+        ("IST1", "1", "20260901", "20270630"),
+        ("ASCESC1", "1", "20260101", "20261231"),
+    ],
+}
+
+# AtouMod: M1 duplicates R1 of Réseau Astuce, its name has no '<>'.
+ATOUMOD = {
+    "stops.txt": [
+        ("stop_id", "stop_name", "stop_lat", "stop_lon"),
+        ("A1", "gare", "49.441000", "1.092000"),
+        ("A2", "bourg", "49.400000", "1.000000"),
+    ],
+    "routes.txt": [
+        ("route_id", "route_short_name", "route_long_name", "route_type"),
+        ("M1", "1", "gare  mairie", "3"),
+        ("M2", "30", "bourg express", "3"),
+    ],
+    "trips.txt": [
+        ("route_id", "service_id", "trip_id"),
+        ("M1", "SVC1", "U1"),
+        ("M2", "SVC1", "U2"),
+    ],
+    "stop_times.txt": [
+        ("trip_id", "stop_id", "stop_sequence"),
+        ("U1", "A1", "1"),
+        ("U2", "A1", "1"),
+        ("U2", "A2", "2"),
+    ],
+    "calendar_dates.txt": [
+        ("service_id", "date", "exception_type"),
+        ("SVC1", "20260105", "1"),
+        ("SVC1", "20260110", "1"),
+        (),  # A blank line, skipped when parsing.
+    ],
+}
+
+# FlixBus: only F1 is in the Métropole Rouen Normandie, X2 never serves it.
+FLIXBUS = {
+    "stops.txt": [
+        ("stop_id", "stop_name", "stop_lat", "stop_lon"),
+        ("F1", "rouen", "49.442000", "1.095000"),
+        ("F2", "paris bercy", "48.840000", "2.380000"),
+        ("F3", "lyon", "45.750000", "4.850000"),
+    ],
+    "routes.txt": [
+        ("route_id", "route_short_name", "route_long_name", "route_type"),
+        ("X1", "N1", "paris rouen", "3"),
+        ("X2", "N2", "paris lyon", "3"),
+    ],
+    "trips.txt": [
+        ("route_id", "service_id", "trip_id"),
+        ("X1", "D1", "V1"),
+        ("X2", "D1", "V2"),
+    ],
+    "stop_times.txt": [
+        ("trip_id", "stop_id", "stop_sequence"),
+        ("V1", "F2", "1"),
+        ("V1", "F1", "2"),
+        ("V2", "F2", "1"),
+        ("V2", "F3", "2"),
+    ],
+    "calendar.txt": [
+        ("service_id", "start_date", "end_date"),
+        ("D1", "20260101", "20260331"),
+    ],
+}
+
+# BlaBlaCar Bus: nothing in the Métropole Rouen Normandie.
+BLABLACARBUS = {
+    "stops.txt": [
+        ("stop_id", "stop_name", "stop_lat", "stop_lon"),
+        ("B1", "lille", "50.630000", "3.060000"),
+    ],
+    "routes.txt": [
+        ("route_id", "route_short_name", "route_long_name", "route_type"),
+        ("Y1", "B", "lille paris", "3"),
+    ],
+    "trips.txt": [("route_id", "service_id", "trip_id"), ("Y1", "E1", "W1")],
+    "stop_times.txt": [("trip_id", "stop_id", "stop_sequence"), ("W1", "B1", "1")],
+    "calendar_dates.txt": [
+        ("service_id", "date", "exception_type"),
+        ("E1", "20260201", "1"),
+    ],
+}
+
+CYCLING = [
+    "id_local;coordonneesxy;mobilier;acces",
+    "C1;(1.090500, 49.440500);ARCEAU;LIBRE ACCES",
+    "C2;(1.100500, 49.450500);PARC;PRIVE",
+]
+
+LOVELO = {
+    "data": {
+        "stations": [
+            {"station_id": "1", "name": "gare", "lat": 49.4405, "lon": 1.0902},
+            {"station_id": "2", "name": "st sever", "lat": 49.4601, "lon": 1.0801},
+        ]
+    }
+}
+
+# Tables compared between databases, with a column order making rows unique.
+COMPARED_TABLES = {
+    "stops": "stop_id, stop_name, stop_lat, stop_lon, stop_geohash",
+    "routes": "route_id, route_short_name, route_long_name, route_type",
+    "cache_stop_routes": "stop_id, route_id, school",
+    "calendar": "service_id, start_date, end_date",
+    "cycle_stops": "cycle_id, cycle_name, cycle_type, cycle_free, cycle_geohash",
+    "stop_summary": "stop_id, stop_name, routes",
+    "stop_areas": "area_name, area_lat, area_lon, area_radius",
+}
+
+
+def load_builder():
+    """Load nearby-create-database.py, whose name is not a module name."""
+    spec = spec_from_file_location("nearby_create_database", SCRIPT)
+    module = module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def write_gtfs(filename: Path, tables: dict):
+    """Write a GTFS archive of CSV files encoded in UTF-8 with BOM.
+
+    Args:
+        filename (Path): The filename of the archive.
+        tables (dict): The rows of each CSV file, header first, indexed by
+            CSV filename. Empty rows are written as blank lines.
+    """
+    with ZipFile(filename, "w") as archive:
+        for csvfile, rows in tables.items():
+            lines = [",".join(row) for row in rows]
+            archive.writestr(csvfile, "\ufeff" + "\n".join(lines) + "\n")
+
+
+class GenerateTransportDatabaseTest(TestCase):
+    """Tests of generate_transport_database."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.builder = load_builder()
+
+    def setUp(self):
+        directory = TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = Path(directory.name)
+
+        # Names normalized by a previous test must come from the names cache.
+        self.builder.NORMALIZED_NAMES.clear()
+
+        # Data files are read from the temporary directory instead of /tmp.
+        for data_info in self.builder.DATA_FILES.values():
+            data_info["temp_file"] = str(
+                self.directory / Path(data_info["temp_file"]).name
+            )
+
+        write_gtfs(self.data_file("astuce"), ASTUCE)
+        write_gtfs(self.data_file("atoumod"), ATOUMOD)
+        write_gtfs(self.data_file("flixbus"), FLIXBUS)
+        write_gtfs(self.data_file("blablacarbus"), BLABLACARBUS)
+        self.data_file("cycling").write_text("\n".join(CYCLING) + "\n")
+        with open(self.data_file("lovélo"), "w", encoding="utf-8") as handle:
+            dump(LOVELO, handle)
+
+    def data_file(self, source: str) -> Path:
+        return Path(self.builder.DATA_FILES[source]["temp_file"])
+
+    def build(self, db_name: str) -> str:
+        """Generate a database in the temporary directory, return its output."""
+        output = StringIO()
+        with redirect_stdout(output):
+            self.builder.generate_transport_database(str(self.directory / db_name))
+
+        return output.getvalue()
+
+    def cached_names(self, db_name: str) -> dict:
+        names_cache = self.directory / (db_name + self.builder.NAMES_CACHE_SUFFIX)
+        with open(names_cache, encoding="utf-8") as handle:
+            return load(handle)["names"]
+
+    def rows(self, db_name: str, table_name: str, columns="*") -> list:
+        with closing(connect(self.directory / db_name)) as connection:
+            return sorted(connection.execute(f"SELECT {columns} FROM {table_name}"))
+
+    def test_full_build(self):
+        self.build("transport.db")
+
+        self.assertEqual(
+            self.rows("transport.db", "stops", "stop_id, stop_name"),
+            [
+                ("AST-S1", "Gare"),
+                ("AST-S2", "Mairie"),
+                ("AST-S3", "Saint Sever"),
+                ("ATM-A1", "Gare"),
+                ("ATM-A2", "Bourg"),
+                ("FLX-F1", "Rouen"),
+            ],
+        )
+        self.assertEqual(
+            self.rows("transport.db", "routes"),
+            [
+                ("AST-R1", "1", "Gare <> Mairie", 3),
+                ("AST-R2", "2", "Saint Sever <> Paris", 3),
+                ("ATM-M2", "30", "Bourg Express", 3),
+                ("FLX-X1", "N1", "Paris Rouen", 3),
+            ],
+        )
+        self.assertEqual(
+            self.rows("transport.db", "cache_stop_routes"),
+            [
+                ("AST-S1", "AST-R1", 0),
+                ("AST-S1", "AST-R1", 1),
+                ("AST-S2", "AST-R1", 0),
+                ("AST-S3", "AST-R2", 0),
+                ("ATM-A1", "ATM-M2", 0),
+                ("ATM-A2", "ATM-M2", 0),
+                ("FLX-F1", "FLX-X1", 0),
+            ],
+        )
+        self.assertEqual(
+            self.rows("transport.db", "calendar"),
+            [
+                ("AST-ASCESC1", "20260101", "20261231"),
+                ("AST-IST1", "20260901", "20270630"),
+                ("AST-WEEK", "20260101", "20261231"),
+                ("ATM-SVC1", "20260105", "20260110"),
+                ("BBC-E1", "20260201", "20260201"),
+                ("FLX-D1", "20260101", "20260331"),
+            ],
+        )
+        self.assertEqual(
+            self.rows("transport.db", "cycle_stops", "cycle_id, cycle_name"),
+            [
+                ("CYC-C1", None),
+                ("CYC-C2", None),
+                ("LOV-1", "Gare"),
+                ("LOV-2", "Saint Sever"),
+            ],
+        )
+
+    def test_rebuild_of_one_changed_source(self):
+        self.build("transport.db")
+        version = stat(self.directory / "transport.db").st_ino
+
+        self.assertIn("Transport database is up to date", self.build("transport.db"))
+        self.assertEqual(stat(self.directory / "transport.db").st_ino, version)
+
+        # F4 is a new FlixBus stop in the Métropole Rouen Normandie.
+        flixbus = {name: list(rows) for (name, rows) in FLIXBUS.items()}
+        flixbus["stops.txt"].append(("F4", "rouen nord", "49.470000", "1.090000"))
+        flixbus["stop_times.txt"].append(("V1", "F4", "3"))
+        write_gtfs(self.data_file("flixbus"), flixbus)
+
+        output = self.build("transport.db")
+        self.assertIn("Updating flixbus", output)
+        self.assertNotIn("Creating database", output)
+
+        # The updated database is the same as one generated from scratch.
+        self.build("scratch.db")
+        for table_name, columns in COMPARED_TABLES.items():
+            with self.subTest(table_name=table_name):
+                self.assertEqual(
+                    self.rows("transport.db", table_name, columns),
+                    self.rows("scratch.db", table_name, columns),
+                )
+
+        self.assertIn(
+            ("FLX-F4", "FLX-X1", 0),
+            self.rows("transport.db", "cache_stop_routes"),
+        )
+
+    def test_names_cache(self):
+        self.build("transport.db")
+        self.assertEqual(self.cached_names("transport.db")["st sever"], "Saint Sever")
+
+        # F1 is renamed, only the FlixBus feed is imported again.
+        flixbus = {name: list(rows) for (name, rows) in FLIXBUS.items()}
+        flixbus["stops.txt"][1] = ("F1", "rouen rive droite", "49.442000", "1.095000")
+        write_gtfs(self.data_file("flixbus"), flixbus)
+        self.build("transport.db")
+
+        # The names of the rows kept from the previous database stay cached.
+        names = self.cached_names("transport.db")
+        self.assertEqual(names["rouen rive droite"], "Rouen Rive Droite")
+        self.assertEqual(names["gare <> mairie"], "Gare <> Mairie")
+        self.assertNotIn("rouen", names)
+
+    def test_invalid_names_cache(self):
+        db_filename = str(self.directory / "transport.db")
+        names_cache = Path(db_filename + self.builder.NAMES_CACHE_SUFFIX)
+
+        checksum = self.builder.corrections_checksum()
+        contents = [
+            "not json",
+            "[]",
+            f'{{"corrections": "{checksum}"}}',
+            f'{{"corrections": "{checksum}", "names": ["gare"]}}',
+        ]
+
+        for content in contents:
+            with self.subTest(content=content):
+                names_cache.write_text(content)
+                self.builder.load_names_cache(db_filename)
+                self.assertEqual(self.builder.NORMALIZED_NAMES, {})
+
+
+if __name__ == "__main__":
+    main()
@@ -1,19 +1,53 @@
 #!/usr/bin/env python3
 from sqlite3 import connect, Row
-from math import radians, asin, sin, cos, sqrt
+from math import radians, degrees, asin, sin, cos, sqrt, pi, isfinite
 from typing import Union
-from fastapi import FastAPI
+from os import stat
+from pathlib import Path
+from heapq import heappush, heappushpop
+from operator import itemgetter
+from itertools import count
+from collections import OrderedDict
+from threading import Lock, local
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
+from asyncio import BoundedSemaphore, gather, get_running_loop
+from json import dumps, loads
+from pydantic import BaseModel
+from fastapi import FastAPI, HTTPException, Body
+from fastapi.responses import StreamingResponse
 from uvicorn import run
 
 EARTH_DIAMETER = 12742000
 TRANSPORT_DB = 'transport.db'
 
-PERFORMANCE_SQLITE_PRAGMAS = {
-    'locking_mode': 'EXCLUSIVE',
-    'journal_mode': 'WAL',
-    'cache_size': '-512000',
-    'secure_delete': 'FALSE',
-    'synchronous': 'OFF',
+# Answer requests from an in-memory spatial index loaded from TRANSPORT_DB
+# instead of querying SQLite for each request.
+USE_MEMORY_INDEX = True
+
+# Search radius in meters of stations and cycle stops.
+STATIONS_DISTANCE = 300
+CYCLE_STOPS_DISTANCE = 150
+
+# Maximum number of locations in a batch request.
+BATCH_MAX_SIZE = 1000
+
+# Number of threads running the station and cycle stop queries, and number of
+# requests allowed to wait for them before answering 503 Service Unavailable.
+QUERY_WORKERS = 8
+QUERY_BACKLOG = 64
+
+# Responses are cached for locations rounded to a grid of RESPONSE_CACHE_GRID
+# meters, the RESPONSE_CACHE_SIZE most recently used ones are kept.
+RESPONSE_CACHE_GRID = 10
+RESPONSE_CACHE_SIZE = 4096
+
+# The server only reads the database, it never needs an exclusive lock and
+# shares the page cache with concurrent readers through mmap.
+READ_SQLITE_PRAGMAS = {
+    'query_only': 'TRUE',
+    'cache_size': '-65536',
+    'mmap_size': '268435456',
     'temp_store': 'MEMORY',
 }
 
@@ -40,57 +74,400 @@ def gps_distance(lat1: float, lon1: float, lat2: float, lon2: float):
     )
 
 
-class SQLiteDB():
-    """Context manager to handle a SQLite database connection."""
+def bounding_box(lat: float, lon: float, max_distance: float):
+    """Bounding box (in radians) of a circle of max_distance meters."""
+    angle = 2 * max_distance / EARTH_DIAMETER
+    lat_delta = angle
+    lon_delta = asin(min(1.0, sin(angle) / cos(lat)))
+
+    return {
+        'min_lat': lat - lat_delta,
+        'max_lat': lat + lat_delta,
+        'min_lon': lon - lon_delta,
+        'max_lon': lon + lon_delta,
+    }
+
+
+class KDTree():
+    """2-d tree of (latitude, longitude, value) points in radians."""
+
+    def __init__(self, points: list):
+        self.size = len(points)
+        self.root = self._build(list(points), 0)
+
+    def _build(self, points: list, axis: int):
+        if not points:
+            return None
+
+        points.sort(key=itemgetter(axis))
+        median = len(points) // 2
+
+        return (
+            points[median],
+            axis,
+            self._build(points[:median], 1 - axis),
+            self._build(points[median + 1:], 1 - axis),
+        )
+
+    def within(self, lat: float, lon: float, max_distance: float):
+        """Points closer than max_distance meters, sorted by distance."""
+        box = bounding_box(lat, lon, max_distance)
+        low = (box['min_lat'], box['min_lon'])
+        high = (box['max_lat'], box['max_lon'])
+
+        found = []
+        nodes = [self.root]
+        while nodes:
+            node = nodes.pop()
+            if node is None:
+                continue
+
+            point, axis, left, right = node
+
+            if low[0] <= point[0] <= high[0] and low[1] <= point[1] <= high[1]:
+                distance = gps_distance(lat, lon, point[0], point[1])
+                if distance < max_distance:
+                    found.append((distance, point[2]))
+
+            if low[axis] <= point[axis]:
+                nodes.append(left)
+
+            if point[axis] <= high[axis]:
+                nodes.append(right)
+
+        found.sort(key=itemgetter(0))
+        return found
+
+    def nearest(self, lat: float, lon: float, k: int):
+        """The k points closest to a location, sorted by distance."""
+        # Max-heap of the best candidates, the counter breaks ties.
+        best = []
+        tie = count()
+
+        def worst():
+            return -best[0][0] if len(best) == k else float('inf')
+
+        def visit(node):
+            if node is None:
+                return
+
+            point, axis, left, right = node
+
+            distance = gps_distance(lat, lon, point[0], point[1])
+            if len(best) < k:
+                heappush(best, (-distance, next(tie), point[2]))
+            elif distance < worst():
+                heappushpop(best, (-distance, next(tie), point[2]))
+
+            delta = (lat, lon)[axis] - point[axis]
+            (near, far) = (right, left) if delta >= 0 else (left, right)
+
+            visit(near)
+
+            # Lower bound of the distance between the location and any point
+            # on the other side of the splitting parallel or meridian.
+            if axis == 0:
+                bound = EARTH_DIAMETER / 2 * abs(delta)
+            else:
+                bound = EARTH_DIAMETER / 2 * asin(
+                    min(1.0, cos(lat) * sin(min(abs(delta), pi / 2)))
+                )
+
+            if bound < worst():
+                visit(far)
+
+        if k > 0:
+            visit(self.root)
+
+        return [(-distance, value) for (distance, _, value) in sorted(best, reverse=True)]
+
+
+class TransportIndex():
+    """In-memory spatial index of stations and cycle stops."""
+
+    def __init__(self, cursor, box=None):
+        # Only load stops inside the box (in radians) when one is given.
+        (stops_box, cycle_stops_box) = ('', '')
+        parameters = box or {}
+        if box:
+            stops_box = """
+                INNER JOIN stops_rtree
+                        ON stops.rowid = stops_rtree.id
+                       AND stops_rtree.max_lat >= :min_lat
+                       AND stops_rtree.min_lat <= :max_lat
+                       AND stops_rtree.max_lon >= :min_lon
+                       AND stops_rtree.min_lon <= :max_lon
+            """
+            cycle_stops_box = stops_box.replace('stops', 'cycle_stops')
+
+        cursor.execute(f"""
+            SELECT
+                stops.stop_id AS 'id',
+                stops.stop_name AS 'stop_name',
+                stops.stop_lat AS 'stop_lat',
+                stops.stop_lon AS 'stop_lon',
+                stops.routes AS 'routes',
+                stop_areas.area_id AS 'area_id',
+                stop_areas.area_lat AS 'area_lat',
+                stop_areas.area_lon AS 'area_lon',
+                stop_areas.area_radius AS 'area_radius'
+            FROM stop_summary AS stops
+            {stops_box}
+            INNER JOIN stop_areas
+                    ON stops.area_id = stop_areas.area_id
+        """, parameters)
+
+        # Stations are grouped in the stop areas built with the database.
+        areas = {}
+        for row in cursor:
+            if row['area_id'] not in areas:
+                areas[row['area_id']] = (row['area_lat'], row['area_lon'], (
+                    row['area_radius'],
+                    [],
+                ))
+
+            areas[row['area_id']][2][1].append((row['stop_lat'], row['stop_lon'], (
+                row['id'],
+                row['stop_name'],
+                degrees(row['stop_lat']),
+                degrees(row['stop_lon']),
+                loads(row['routes']),
+            )))
+
+        self.areas = KDTree(list(areas.values()))
+        self.area_radius = max((area[2][0] for area in areas.values()), default=0)
+        self.stations = KDTree([
+            station
+            for (_, _, (_, stations)) in areas.values()
+            for station in stations
+        ])
+
+        cursor.execute(f"""
+            SELECT
+                cycle_stops.cycle_id AS 'id',
+                cycle_stops.cycle_name AS 'name',
+                cycle_stops.cycle_type AS 'type',
+                cycle_stops.cycle_free AS 'free',
+                cycle_stops.cycle_lat AS 'cycle_lat',
+                cycle_stops.cycle_lon AS 'cycle_lon'
+            FROM cycle_stops
+            {cycle_stops_box}
+        """, parameters)
+
+        self.cycle_stops = KDTree([
+            (row['cycle_lat'], row['cycle_lon'], {
+                'id': row['id'],
+                'name': row['name'],
+                'type': row['type'],
+                'free': row['free'],
+                'lat': degrees(row['cycle_lat']),
+                'lon': degrees(row['cycle_lon']),
+            })
+            for row in cursor
+        ])
+
+    def find_stations(self, max_distance: int, lat: float, lon: float):
+        (lat, lon) = (radians(lat), radians(lon))
+
+        # An area whose centroid is farther than max_distance plus its radius
+        # has no station within max_distance.
+        stations = []
+        areas = self.areas.within(lat, lon, max_distance + self.area_radius)
+        for area_distance, (area_radius, area_stations) in areas:
+            if area_distance - area_radius >= max_distance:
+                continue
+
+            for (stop_lat, stop_lon, station) in area_stations:
+                distance = gps_distance(lat, lon, stop_lat, stop_lon)
+                if distance < max_distance:
+                    stations.append((distance, station))
+
+        # Stations at the same distance are ordered by id.
+        stations.sort(key=lambda station: (station[0], station[1][0]))
+        return station_rows(stations)
+
+    def nearest_stations(self, k: int, lat: float, lon: float):
+        stations = self.stations.nearest(radians(lat), radians(lon), k)
+        return station_rows(stations)
+
+    def find_cycle_stops(self, max_distance: int, lat: float, lon: float):
+        cycle_stops = self.cycle_stops.within(radians(lat), radians(lon), max_distance)
+        return [{**cycle_stop, 'distance': distance} for distance, cycle_stop in cycle_stops]
+
+    def nearest_cycle_stops(self, k: int, lat: float, lon: float):
+        cycle_stops = self.cycle_stops.nearest(radians(lat), radians(lon), k)
+        return [{**cycle_stop, 'distance': distance} for distance, cycle_stop in cycle_stops]
+
+
+def station_rows(stations: list):
+    """Rows of (distance, (id, name, lat, lon, routes)) stations, one per route."""
+    rows = [
+        {
+            'id': stop_id,
+            'stop_name': stop_name,
+            'route_short_name': route_short_name,
+            'route_long_name': route_long_name,
+            'school': school,
+            'lat': stop_lat,
+            'lon': stop_lon,
+            'distance': distance,
+        }
+        for distance, (stop_id, stop_name, stop_lat, stop_lon, routes) in stations
+        for (route_short_name, route_long_name, school) in routes
+    ]
+    rows.sort(key=itemgetter('distance', 'school'))
+    return rows
+
+
+class ResponseCache():
+    """LRU cache of responses, emptied when the database changes."""
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.responses = OrderedDict()
+        self.lock = Lock()
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, version):
+        with self.lock:
+            if version != self.version:
+                self.responses.clear()
+                self.version = version
+
+            response = self.responses.get(key)
+            if response is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.responses.move_to_end(key)
+            return response
+
+    def put(self, key, version, response):
+        with self.lock:
+            if version != self.version:
+                return
+
+            self.responses[key] = response
+            self.responses.move_to_end(key)
+            if len(self.responses) > self.max_size:
+                self.responses.popitem(last=False)
+
+    def statistics(self):
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self.responses),
+                'max_size': self.max_size,
+            }
+
+
+def quantize(latitude: float, longitude: float, grid: float):
+    """Round a location (in degrees) to the center of its grid cell."""
+    lat_step = degrees(2 * grid / EARTH_DIAMETER)
+    lat_cell = round(latitude / lat_step)
+    latitude = lat_cell * lat_step
+
+    lon_step = lat_step / cos(radians(latitude))
+    lon_cell = round(longitude / lon_step)
+    longitude = lon_cell * lon_step
+
+    return ((lat_cell, lon_cell), latitude, longitude)
+
+
+def check_finite(latitude: float, longitude: float):
+    """Refuse nan and inf, which are valid floats but not locations."""
+    if not (isfinite(latitude) and isfinite(longitude)):
+        raise HTTPException(
+            status_code=422,
+            detail='Latitude and longitude must be finite numbers',
+        )
+
+
+def file_version(filename):
+    """Identity of a file, changes when the file is replaced or modified."""
+    status = stat(filename)
+    return (status.st_dev, status.st_ino, status.st_mtime_ns)
+
+
+class ConnectionPool():
+    """Read-only SQLite connections, one per thread.
+
+    The database may be atomically replaced while being served. A thread
+    closes its connection to the replaced file the next time it asks for a
+    connection, so no other thread can be using it.
+    """
 
     def __init__(self, db_filename):
         self.db_filename = db_filename
-        self.connection = None
-        self.cursor = None
+        self.uri = Path(db_filename).absolute().as_uri() + '?mode=ro'
+        self.local = local()
+        self.lock = Lock()
+        self.connections = []
 
-    def __enter__(self):
-        self.connection = connect(self.db_filename)
-        self.connection.row_factory = Row
-        self.cursor = self.connection.cursor()
+    def connection(self):
+        connection = getattr(self.local, 'connection', None)
+        version = file_version(self.db_filename)
 
-        for key, value in PERFORMANCE_SQLITE_PRAGMAS.items():
-            self.cursor.execute(f"PRAGMA {key} = {value}")
+        if connection is not None and self.local.version != version:
+            with self.lock:
+                self.connections.remove(connection)
+            connection.close()
+            connection = None
 
-        return self.cursor
+        if connection is None:
+            connection = connect(self.uri, uri=True, check_same_thread=False)
+            connection.row_factory = Row
 
-    def __exit__(self, *args):
-        self.connection.commit()
-        self.connection.close()
+            for key, value in READ_SQLITE_PRAGMAS.items():
+                connection.execute(f"PRAGMA {key} = {value}")
+
+            (self.local.connection, self.local.version) = (connection, version)
+            with self.lock:
+                self.connections.append(connection)
+
+        return connection
+
+    def close(self):
+        with self.lock:
+            for connection in self.connections:
+                connection.close()
+            self.connections.clear()
+
+        self.local = local()
 
 
 def find_stations(cursor, max_distance: int, lat: float, lon: float):
     lat = radians(lat)
     lon = radians(lon)
 
+    # One row per stop, its routes are expanded by station_rows.
     sql = """
         SELECT
-            stops.stop_id AS 'id',
-            stops.stop_name AS 'stop_name',
-            routes.route_short_name AS 'route_short_name',
-            routes.route_long_name AS 'route_long_name',
-            cache_stop_routes.school AS 'school',
-            DEGREES(stops.stop_lat) AS 'lat',
-            DEGREES(stops.stop_lon) AS 'lon',
+            stop_summary.stop_id AS 'id',
+            stop_summary.stop_name AS 'stop_name',
+            stop_summary.routes AS 'routes',
+            DEGREES(stop_summary.stop_lat) AS 'lat',
+            DEGREES(stop_summary.stop_lon) AS 'lon',
             :diameter * ASIN(
                 SQRT(
-                    POW(SIN((:latitude - stops.stop_lat) / 2), 2) +
+                    POW(SIN((:latitude - stop_summary.stop_lat) / 2), 2) +
                     COS(:latitude) *
-                    COS(stops.stop_lat) *
-                    POW(SIN((:longitude - stops.stop_lon) / 2), 2)
+                    COS(stop_summary.stop_lat) *
+                    POW(SIN((:longitude - stop_summary.stop_lon) / 2), 2)
                 )
             ) AS 'distance'
-        FROM stops
-        INNER JOIN cache_stop_routes
-                ON stops.stop_id = cache_stop_routes.stop_id
-        INNER JOIN routes
-                ON cache_stop_routes.route_id = routes.route_id
-        WHERE distance < :max_distance
-        ORDER BY distance, school
+        FROM stops_rtree
+        INNER JOIN stop_summary
+                ON stop_summary.rowid = stops_rtree.id
+        WHERE stops_rtree.max_lat >= :min_lat
+          AND stops_rtree.min_lat <= :max_lat
+          AND stops_rtree.max_lon >= :min_lon
+          AND stops_rtree.min_lon <= :max_lon
+          AND distance < :max_distance
     """
     cursor.execute(
         sql,
@@ -98,10 +475,16 @@ def find_stations(cursor, max_distance: int, lat: float, lon: float):
             'diameter': EARTH_DIAMETER,
             'latitude': lat,
             'longitude': lon,
-            'max_distance': max_distance
+            'max_distance': max_distance,
+            **bounding_box(lat, lon, max_distance),
         }
     )
-    return [row for row in cursor.fetchall()]
+    return station_rows([
+        (row['distance'], (
+            row['id'], row['stop_name'], row['lat'], row['lon'], loads(row['routes'])
+        ))
+        for row in cursor.fetchall()
+    ])
 
 
 def find_cycle_stops(cursor, max_distance: int, lat: float, lon: float):
@@ -125,8 +508,14 @@ def find_cycle_stops(cursor, max_distance: int, lat: float, lon: float):
                     POW(SIN((:longitude - cycle_stops.cycle_lon) / 2), 2)
                 )
             ) AS 'distance'
-        FROM cycle_stops
-        WHERE distance < :max_distance
+        FROM cycle_stops_rtree
+        INNER JOIN cycle_stops
+                ON cycle_stops.rowid = cycle_stops_rtree.id
+        WHERE cycle_stops_rtree.max_lat >= :min_lat
+          AND cycle_stops_rtree.min_lat <= :max_lat
+          AND cycle_stops_rtree.max_lon >= :min_lon
+          AND cycle_stops_rtree.min_lon <= :max_lon
+          AND distance < :max_distance
         ORDER BY distance
     """
     cursor.execute(
@@ -135,7 +524,8 @@ def find_cycle_stops(cursor, max_distance: int, lat: float, lon: float):
             'diameter': earth_diameter,
             'latitude': lat,
             'longitude': lon,
-            'max_distance': max_distance
+            'max_distance': max_distance,
+            **bounding_box(lat, lon, max_distance),
         }
     )
     return [row for row in cursor.fetchall()]
@@ -173,11 +563,11 @@ def compare_positions(lat1: float, lon1: float, lat2: float, lon2: float):
     return (int(distance), direction)
 
 
-def prepare_stations(cursor, distance: float, latitude: float, longitude: float):
+def prepare_stations(stations: list):
     near_points = {}
     used = set()
 
-    for row in find_stations(cursor, 300, latitude, longitude):
+    for row in stations:
         route_short_name = row['route_short_name']
         school = bool(int(row['school']))
 
@@ -221,10 +611,10 @@ def prepare_stations(cursor, distance: float, latitude: float, longitude: float)
     return near_points
 
 
-def prepare_cycle_stops(cursor, distance: float, latitude: float, longitude: float):
+def prepare_cycle_stops(cycle_stops: list, latitude: float, longitude: float):
     near_points = {}
 
-    for row in find_cycle_stops(cursor, 150, latitude, longitude):
+    for row in cycle_stops:
         distance = int(row['distance'])
         stop_name = row['name']
         stop_type = row['type']
@@ -256,19 +646,236 @@ def prepare_cycle_stops(cursor, distance: float, latitude: float, longitude: flo
     return near_points
 
 
-near_facilities_app = FastAPI()
+connection_pool_lock = Lock()
+connection_pool_cache = {'pool': None}
+
+
+def connection_pool():
+    """Read-only ConnectionPool of TRANSPORT_DB, created on first use."""
+    if connection_pool_cache['pool'] is None:
+        with connection_pool_lock:
+            if connection_pool_cache['pool'] is None:
+                connection_pool_cache['pool'] = ConnectionPool(TRANSPORT_DB)
+
+    return connection_pool_cache['pool']
+
+
+def database_version():
+    """Version of TRANSPORT_DB, changes each time the file is replaced."""
+    return file_version(TRANSPORT_DB)
+
+
+transport_index_lock = Lock()
+transport_index_cache = {'version': None, 'index': None}
+
+
+def transport_index():
+    """Current TransportIndex, reloaded when TRANSPORT_DB changes."""
+    version = database_version()
+
+    # The index is always stored before its version, no lock needed here.
+    if transport_index_cache['version'] == version:
+        return transport_index_cache['index']
+
+    with transport_index_lock:
+        if transport_index_cache['version'] != version:
+            cursor = connection_pool().connection().cursor()
+            transport_index_cache['index'] = TransportIndex(cursor)
+            transport_index_cache['version'] = version
+
+        return transport_index_cache['index']
+
+
+query_executor_lock = Lock()
+query_executor_cache = {'executor': None}
+
+
+def query_executor():
+    """ThreadPoolExecutor running the queries, created on first use."""
+    if query_executor_cache['executor'] is None:
+        with query_executor_lock:
+            if query_executor_cache['executor'] is None:
+                query_executor_cache['executor'] = ThreadPoolExecutor(
+                    max_workers=QUERY_WORKERS,
+                    thread_name_prefix='query',
+                )
+
+    return query_executor_cache['executor']
+
+
+query_slots = BoundedSemaphore(QUERY_BACKLOG)
+response_cache = ResponseCache(RESPONSE_CACHE_SIZE)
+
+
+def nearby_stations(latitude: float, longitude: float):
+    if USE_MEMORY_INDEX:
+        stations = transport_index().find_stations(
+            STATIONS_DISTANCE, latitude, longitude
+        )
+    else:
+        cursor = connection_pool().connection().cursor()
+        stations = find_stations(cursor, STATIONS_DISTANCE, latitude, longitude)
+
+    return prepare_stations(stations)
+
+
+def nearby_cycle_stops(latitude: float, longitude: float):
+    if USE_MEMORY_INDEX:
+        cycle_stops = transport_index().find_cycle_stops(
+            CYCLE_STOPS_DISTANCE, latitude, longitude
+        )
+    else:
+        cursor = connection_pool().connection().cursor()
+        cycle_stops = find_cycle_stops(
+            cursor, CYCLE_STOPS_DISTANCE, latitude, longitude
+        )
+
+    return prepare_cycle_stops(cycle_stops, latitude, longitude)
+
+
+def batch_index(locations: list):
+    """TransportIndex of the candidates of all locations of a batch."""
+    if USE_MEMORY_INDEX:
+        return transport_index()
+
+    # One scan of the bounding box enclosing every location.
+    distance = max(STATIONS_DISTANCE, CYCLE_STOPS_DISTANCE)
+    boxes = [
+        bounding_box(radians(location.latitude), radians(location.longitude), distance)
+        for location in locations
+    ]
+    box = {
+        'min_lat': min(box['min_lat'] for box in boxes),
+        'max_lat': max(box['max_lat'] for box in boxes),
+        'min_lon': min(box['min_lon'] for box in boxes),
+        'max_lon': max(box['max_lon'] for box in boxes),
+    }
+
+    cursor = connection_pool().connection().cursor()
+    return TransportIndex(cursor, box)
+
+
+def batch_facilities(index: TransportIndex, locations: list):
+    """Facilities of each location as JSON lines."""
+    lines = []
+    for location in locations:
+        (latitude, longitude) = (location.latitude, location.longitude)
+        stations = index.find_stations(STATIONS_DISTANCE, latitude, longitude)
+        cycle_stops = index.find_cycle_stops(CYCLE_STOPS_DISTANCE, latitude, longitude)
+
+        lines.append(dumps({
+            'latitude': latitude,
+            'longitude': longitude,
+            'stations': prepare_stations(stations),
+            'cycle_stops': prepare_cycle_stops(cycle_stops, latitude, longitude),
+        }) + '\n')
+
+    return ''.join(lines)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    connection_pool()
+    query_executor()
+
+    if USE_MEMORY_INDEX:
+        transport_index()
+
+    yield
+
+    query_executor().shutdown()
+    connection_pool().close()
+
+
+near_facilities_app = FastAPI(lifespan=lifespan)
 
 
-@near_facilities_app.get("/transport_facilities/{latitude}/{longitude}")
 def find_facilities(latitude: float, longitude: float):
     latitude = float(latitude)
     longitude = float(longitude)
 
-    with SQLiteDB(TRANSPORT_DB) as cursor:
-        return {
-            'stations': prepare_stations(cursor, 300, latitude, longitude),
-            'cycle_stops': prepare_cycle_stops(cursor, 150, latitude, longitude),
-        }
+    return {
+        'stations': nearby_stations(latitude, longitude),
+        'cycle_stops': nearby_cycle_stops(latitude, longitude),
+    }
+
+
+@near_facilities_app.get("/transport_facilities/{latitude}/{longitude}")
+async def find_facilities_async(latitude: float, longitude: float):
+    check_finite(latitude, longitude)
+    (key, latitude, longitude) = quantize(latitude, longitude, RESPONSE_CACHE_GRID)
+    version = database_version()
+
+    facilities = response_cache.get(key, version)
+    if facilities is not None:
+        return facilities
+
+    # Refuse the request right away instead of queueing it without limit.
+    if query_slots.locked():
+        raise HTTPException(
+            status_code=503,
+            detail='Too many pending requests',
+            headers={'Retry-After': '1'},
+        )
+
+    async with query_slots:
+        loop = get_running_loop()
+        (stations, cycle_stops) = await gather(
+            loop.run_in_executor(query_executor(), nearby_stations, latitude, longitude),
+            loop.run_in_executor(query_executor(), nearby_cycle_stops, latitude, longitude),
+        )
+
+    facilities = {
+        'stations': stations,
+        'cycle_stops': cycle_stops,
+    }
+
+    response_cache.put(key, version, facilities)
+
+    return facilities
+
+
+class Location(BaseModel):
+    latitude: float
+    longitude: float
+
+
+@near_facilities_app.post("/transport_facilities")
+async def find_facilities_batch(
+    locations: list[Location] = Body(min_length=1, max_length=BATCH_MAX_SIZE)
+):
+    """Facilities of many locations, streamed as one JSON object per line."""
+    for location in locations:
+        check_finite(location.latitude, location.longitude)
+
+    if query_slots.locked():
+        raise HTTPException(
+            status_code=503,
+            detail='Too many pending requests',
+            headers={'Retry-After': '1'},
+        )
+
+    async def stream():
+        # The slot is held until the whole batch has been streamed.
+        async with query_slots:
+            loop = get_running_loop()
+            index = await loop.run_in_executor(query_executor(), batch_index, locations)
+
+            # Answer the locations by chunks to let other requests interleave.
+            for start in range(0, len(locations), 32):
+                yield await loop.run_in_executor(
+                    query_executor(),
+                    batch_facilities,
+                    index,
+                    locations[start:start + 32],
+                )
+
+    return StreamingResponse(stream(), media_type='application/x-ndjson')
+
+
+@near_facilities_app.get("/cache_statistics")
+def cache_statistics():
+    return response_cache.statistics()
 
 
 def run_server():
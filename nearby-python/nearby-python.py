@@ -1,15 +1,71 @@
 #!/usr/bin/env python3
 
 from sqlite3 import connect, Row
-from math import radians, asin, sin, cos, sqrt
+from math import radians, degrees, asin, sin, cos, sqrt, floor
 
 EARTH_DIAMETER = 12742000
 
+# Must match the precision used by nearby-create-database.py.
+GEOHASH_PRECISION = 6
+GEOHASH_ALPHABET = "0123456789bcdefghjkmnpqrstuvwxyz"
+
+
+def geohash(latitude: float, longitude: float, precision=GEOHASH_PRECISION):
+    (lat_min, lat_max) = (-90.0, 90.0)
+    (lon_min, lon_max) = (-180.0, 180.0)
+
+    cell = []
+    for char_index in range(precision):
+        value = 0
+        for bit_index in range(5):
+            # Bits alternate between longitude and latitude, longitude first.
+            if (char_index * 5 + bit_index) % 2 == 0:
+                middle = (lon_min + lon_max) / 2
+                bit = longitude >= middle
+                (lon_min, lon_max) = (middle, lon_max) if bit else (lon_min, middle)
+            else:
+                middle = (lat_min + lat_max) / 2
+                bit = latitude >= middle
+                (lat_min, lat_max) = (middle, lat_max) if bit else (lat_min, middle)
+
+            value = value * 2 + bit
+
+        cell.append(GEOHASH_ALPHABET[value])
+
+    return "".join(cell)
+
+
+def geohash_cells(lat: float, lon: float, max_distance: int):
+    """Geohash cells covering a circle of max_distance meters (in degrees)."""
+    bits = 5 * GEOHASH_PRECISION
+    lat_step = 180.0 / 2 ** (bits // 2)
+    lon_step = 360.0 / 2 ** (bits - bits // 2)
+
+    angle = 2 * max_distance / EARTH_DIAMETER
+    lat_delta = degrees(angle)
+    lon_delta = degrees(asin(min(1.0, sin(angle) / cos(radians(lat)))))
+
+    lat_cells = range(
+        floor((lat - lat_delta + 90) / lat_step),
+        floor((lat + lat_delta + 90) / lat_step) + 1
+    )
+    lon_cells = range(
+        floor((lon - lon_delta + 180) / lon_step),
+        floor((lon + lon_delta + 180) / lon_step) + 1
+    )
+
+    return [
+        geohash((lat_cell + 0.5) * lat_step - 90, (lon_cell + 0.5) * lon_step - 180)
+        for lat_cell in lat_cells
+        for lon_cell in lon_cells
+    ]
+
 
 def gtfs(database_filename: str, max_distance: int, lat: float, lon: float):
     connection = connect(database_filename)
     connection.row_factory = Row
     cursor = connection.cursor()
+    cells = geohash_cells(lat, lon, max_distance)
     lat = radians(lat)
     lon = radians(lon)
 
@@ -35,16 +91,18 @@ def gtfs(database_filename: str, max_distance: int, lat: float, lon: float):
                 ON stops.stop_id = cache_stop_routes.stop_id
         INNER JOIN routes
                 ON cache_stop_routes.route_id = routes.route_id
-        WHERE distance < :max_distance
+        WHERE stops.stop_geohash IN ({cells})
+          AND distance < :max_distance
         ORDER BY distance, school
-    """
+    """.format(cells=", ".join(f":cell{index}" for index in range(len(cells))))
     cursor.execute(
         sql,
         {
             'diameter': EARTH_DIAMETER,
             'latitude': lat,
             'longitude': lon,
-            'max_distance': max_distance
+            'max_distance': max_distance,
+            **{f'cell{index}': cell for index, cell in enumerate(cells)},
         }
     )
     return [row for row in cursor.fetchall()]
@@ -97,6 +155,7 @@ def cycle_stops(database_filename: str, max_distance: int, lat: float, lon: floa
     connection = connect(database_filename)
     connection.row_factory = Row
     cursor = connection.cursor()
+    cells = geohash_cells(lat, lon, max_distance)
     lat = radians(lat)
     lon = radians(lon)
     earth_diameter = 12742000
@@ -118,16 +177,18 @@ def cycle_stops(database_filename: str, max_distance: int, lat: float, lon: floa
                 )
             ) AS 'distance'
         FROM cycle_stops
-        WHERE distance < :max_distance
+        WHERE cycle_stops.cycle_geohash IN ({cells})
+          AND distance < :max_distance
         ORDER BY distance
-    """
+    """.format(cells=", ".join(f":cell{index}" for index in range(len(cells))))
     cursor.execute(
         sql,
         {
             'diameter': earth_diameter,
             'latitude': lat,
             'longitude': lon,
-            'max_distance': max_distance
+            'max_distance': max_distance,
+            **{f'cell{index}': cell for index, cell in enumerate(cells)},
         }
     )
     return [row for row in cursor.fetchall()]